@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+"""Benchmarks for the detection-to-reply pipeline, runnable offline.
+
+Drives generate_reference, generate_blurred and the bot's photo -> request
+flow on the bundled samples and on synthesized variants (1-99 faces, 1-24 MP).
+Rekognition, DynamoDB and Telegram are replaced by local stand-ins.
+
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --faces 1,30,99 --megapixels 1,12,24 --iterations 5
+"""
+
+import os
+import io
+import sys
+import glob
+import json
+import time
+import shutil
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import statistics
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SAMPLES = os.path.join(ROOT, "samples")
+WORK_DIR = tempfile.mkdtemp(prefix="bench-")
+
+# Stand-ins must be configured before the bot modules read the environment
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+os.environ["USAGE_TABLE_BACKEND"] = "memory"
+os.environ["TMP_FOLDER"] = os.path.join(WORK_DIR, "tmp")
+os.environ["DETECTION_CACHE_FOLDER"] = ""
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from PIL import Image  # noqa: E402
+
+import bot  # noqa: E402
+import helper_aws  # noqa: E402
+import helper_render  # noqa: E402
+from helper_metrics import metrics  # noqa: E402
+from helper_faces import faces_from_response  # noqa: E402
+from helper_detectors import RekognitionDetector  # noqa: E402
+from helper_images import generate_reference, generate_blurred  # noqa: E402
+
+# STAND-INS ####################################################################
+
+
+class FakeRekognition:
+    """Answers DetectFaces with a recorded or synthesized response."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.response = {"FaceDetails": []}
+        self.calls = 0
+
+    def detect_faces(self, Image, Attributes):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self.response
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.first_name = f"bench-{user_id}"
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+class FakeFile:
+    def __init__(self, image_path: str, file_id: str):
+        self.image_path = image_path
+        self.file_id = file_id
+        self.file_path = f"photos/{file_id}.jpg"
+
+    async def download_to_drive(self, custom_path):
+        await asyncio.to_thread(shutil.copyfile, self.image_path, custom_path)
+
+    async def download_to_memory(self, out):
+        with open(self.image_path, "rb") as image_file:
+            out.write(image_file.read())
+
+
+class FakePhotoSize:
+    def __init__(self, image_path: str, file_id: str):
+        self.file_id = file_id
+        self.file_unique_id = f"unique-{file_id}"
+        self._file = FakeFile(image_path, file_id)
+
+    async def get_file(self):
+        return self._file
+
+
+class FakeMessage:
+    """Records replies; uploads are simulated by reading the payload."""
+
+    def __init__(self, user: FakeUser, text: str = None, photo: list = None):
+        self.from_user = user
+        self.text = text
+        self.photo = photo or []
+        self.media_group_id = None
+        self.uploaded_bytes = 0
+
+    async def reply_text(self, text, **kwargs):
+        return None
+
+    async def reply_photo(self, photo, caption=None, **kwargs):
+        """Count the upload and answer like Telegram, with the file_id of the photo sent."""
+        if isinstance(photo, io.BytesIO):
+            self.uploaded_bytes += len(photo.getvalue())
+        elif os.path.exists(photo):
+            self.uploaded_bytes += os.path.getsize(photo)
+        file_id = f"sent-{getattr(photo, 'name', photo)}"
+        return FakeMessage(self.from_user, photo=[FakePhotoSize(None, file_id)])
+
+
+class FakeUpdate:
+    def __init__(self, message: FakeMessage):
+        self.message = message
+        self.effective_user = message.from_user
+
+
+class FakeBot:
+    def __init__(self):
+        self.files = {}
+
+    async def get_file(self, file_id):
+        return self.files[file_id]
+
+
+class FakeContext:
+    def __init__(self, fake_bot: FakeBot):
+        self.user_data = {"choice": True, "counter": 0}
+        self.bot = fake_bot
+
+
+# WORKLOADS ####################################################################
+
+
+def sample_cases() -> list:
+    """(name, image path, DetectFaces response) for every bundled sample."""
+    cases = []
+    for json_path in sorted(glob.glob(os.path.join(SAMPLES, "*.jpg.json"))):
+        image_path = json_path[: -len(".json")]
+        with open(json_path) as json_file:
+            response = json.load(json_file)
+        name = f"sample-{os.path.basename(image_path)[-16:-4]}"
+        cases.append((name, image_path, response))
+    return cases
+
+
+def synthesize_case(faces: int, megapixels: float, seed: int = 0) -> tuple:
+    """Resize a sample to `megapixels` and lay `faces` boxes out on a grid."""
+    source = sorted(glob.glob(os.path.join(SAMPLES, "*MAQ.jpg")))[0]
+    image = Image.open(source).convert("RGB")
+    ratio = image.width / image.height
+    height = int((megapixels * 1_000_000 / ratio) ** 0.5)
+    width = int(height * ratio)
+    image = image.resize((width, height), Image.BILINEAR)
+
+    image_path = os.path.join(WORK_DIR, f"synthetic-{faces}f-{megapixels}mp.jpg")
+    image.save(image_path, quality=90)
+
+    rng = random.Random(seed)
+    columns = max(1, int(faces**0.5 + 0.999))
+    rows = (faces + columns - 1) // columns
+    cell_width, cell_height = 1.0 / columns, 1.0 / rows
+    details = []
+    for index in range(faces):
+        row, column = divmod(index, columns)
+        box_width = cell_width * rng.uniform(0.4, 0.7)
+        box_height = cell_height * rng.uniform(0.5, 0.8)
+        details.append(
+            {
+                "BoundingBox": {
+                    "Width": box_width,
+                    "Height": box_height,
+                    "Left": column * cell_width + (cell_width - box_width) / 2,
+                    "Top": row * cell_height + (cell_height - box_height) / 2,
+                },
+                "Confidence": 99.0,
+            }
+        )
+
+    return f"synthetic-{faces}f-{megapixels}mp", image_path, {"FaceDetails": details}
+
+
+# MEASUREMENT ##################################################################
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def peak_rss_mb() -> float:
+    """Peak RSS of this process plus the render workers, in MB (Linux)."""
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    executor = helper_render._render_executor
+    for process in (
+        list(getattr(executor, "_processes", {}).values()) if executor else []
+    ):
+        try:
+            with open(f"/proc/{process.pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        peak_kb += int(line.split()[1])
+        except OSError:
+            pass
+    return peak_kb / 1024
+
+
+def summarize(stage: str, case: str, timings: list) -> dict:
+    total = sum(timings)
+    return {
+        "stage": stage,
+        "case": case,
+        "runs": len(timings),
+        "p50_ms": percentile(timings, 0.50) * 1000,
+        "p90_ms": percentile(timings, 0.90) * 1000,
+        "p99_ms": percentile(timings, 0.99) * 1000,
+        "mean_ms": statistics.mean(timings) * 1000,
+        "throughput_per_s": len(timings) / total if total else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+async def timed(coroutine_factory, iterations: int) -> list:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await coroutine_factory()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+async def bench_renderers(
+    name: str, image_path: str, response: dict, iterations: int
+) -> list:
+    faces = faces_from_response(response)
+    output_path = os.path.join(WORK_DIR, "renders")
+    os.makedirs(output_path, exist_ok=True)
+    _, faces_detail = await generate_reference(
+        image_path, output_path, "bench", "jpg", faces
+    )
+    ids = list(faces_detail)
+
+    reference = await timed(
+        lambda: generate_reference(image_path, output_path, "bench", "jpg", faces),
+        iterations,
+    )
+    blurred = await timed(
+        lambda: generate_blurred(
+            image_path, output_path, "bench", "jpg", faces_detail, ids
+        ),
+        iterations,
+    )
+    return [
+        summarize("generate_reference", name, reference),
+        summarize("generate_blurred", name, blurred),
+    ]
+
+
+async def bench_flow(
+    name: str, image_path: str, response: dict, iterations: int, fake_rekognition
+) -> list:
+    """photo -> request("all") through the real handlers, cold detection each run."""
+    fake_rekognition.response = response
+    fake_bot = FakeBot()
+    photo_timings, request_timings = [], []
+
+    for iteration in range(iterations):
+        user = FakeUser(1000 + iteration)
+        file_id = f"{name}-{iteration}"
+        photo_size = FakePhotoSize(image_path, file_id)
+        fake_bot.files[file_id] = photo_size._file
+        context = FakeContext(fake_bot)
+        helper_aws.detection_cache.clear()
+
+        start = time.perf_counter()
+        await bot.photo(FakeUpdate(FakeMessage(user, photo=[photo_size])), context)
+        photo_timings.append(time.perf_counter() - start)
+
+        if "faces_detail" not in context.user_data:
+            continue
+
+        start = time.perf_counter()
+        await bot.request(FakeUpdate(FakeMessage(user, text="all")), context)
+        request_timings.append(time.perf_counter() - start)
+
+    results = [summarize("flow_photo", name, photo_timings)]
+    if request_timings:
+        results.append(summarize("flow_request_all", name, request_timings))
+    return results
+
+
+def print_report(results: list) -> None:
+    header = f"{'stage':<20} {'case':<28} {'runs':>4} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'ops/s':>8} {'rss MB':>8}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            f"{result['stage']:<20} {result['case']:<28} {result['runs']:>4} "
+            f"{result['p50_ms']:>9.1f} {result['p90_ms']:>9.1f} {result['p99_ms']:>9.1f} "
+            f"{result['throughput_per_s']:>8.2f} {result['peak_rss_mb']:>8.0f}"
+        )
+
+
+async def run(args) -> list:
+    fake_rekognition = FakeRekognition(latency=args.rekognition_latency / 1000)
+    helper_aws.detector = RekognitionDetector(
+        fake_rekognition, helper_aws.detection_attributes
+    )
+
+    cases = [] if args.skip_samples else sample_cases()
+    for faces in args.faces:
+        for megapixels in args.megapixels:
+            cases.append(synthesize_case(faces, megapixels))
+
+    results = []
+    for name, image_path, response in cases:
+        results += await bench_renderers(name, image_path, response, args.iterations)
+        if not args.skip_flow:
+            results += await bench_flow(
+                name, image_path, response, args.iterations, fake_rekognition
+            )
+    return results
+
+
+def parse_list(value: str) -> list:
+    return [
+        float(item) if "." in item else int(item) for item in value.split(",") if item
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--faces", type=parse_list, default=[1, 10, 30, 99])
+    parser.add_argument("--megapixels", type=parse_list, default=[1, 6, 12, 24])
+    parser.add_argument(
+        "--rekognition-latency",
+        type=float,
+        default=0.0,
+        help="simulated DetectFaces latency, ms",
+    )
+    parser.add_argument("--skip-samples", action="store_true")
+    parser.add_argument("--skip-flow", action="store_true")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        helper_render.shutdown_render_pool()
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    print_report(results)
+    print()
+    print("Stage breakdown:")
+    for part in metrics.summary().split(" | "):
+        print(f"  {part}")
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
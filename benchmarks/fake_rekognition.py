@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Local stand-in for a Rekognition endpoint, fully offline.
+
+Speaks the DetectFaces JSON protocol over HTTP and answers with the recorded
+samples/*.json responses, with a simulated latency and a share of throttled
+calls. Start a few of them to try the client pool and its failover:
+
+    python benchmarks/fake_rekognition.py --port 9001 --latency 300
+    python benchmarks/fake_rekognition.py --port 9002 --latency 300 --throttle 0.5
+
+    REKOGNITION_ENDPOINTS="name=a;region=eu-west-1;endpoint_url=http://127.0.0.1:9001,\\
+    name=b;region=eu-west-1;endpoint_url=http://127.0.0.1:9002"
+
+boto3 still signs the requests: any AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY
+will do.
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from helper_detectors import ReplayDetector  # noqa: E402
+
+
+class FakeRekognitionHandler(BaseHTTPRequestHandler):
+    detector = None
+    latency = 0.0
+    throttle = 0.0
+    calls = 0
+    throttled = 0
+
+    def _reply(self, status: int, body: dict) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/x-amz-json-1.1")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self) -> None:
+        request = json.loads(
+            self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}"
+        )
+        target = self.headers.get("X-Amz-Target", "")
+        cls = type(self)
+        cls.calls += 1
+
+        if target != "RekognitionService.DetectFaces":
+            self._reply(
+                400,
+                {"__type": "InvalidAction", "message": f"{target} is not supported"},
+            )
+            return
+        if random.random() < cls.throttle:
+            cls.throttled += 1
+            self._reply(
+                400, {"__type": "ThrottlingException", "message": "Rate exceeded"}
+            )
+            return
+
+        if cls.latency:
+            time.sleep(cls.latency)
+        image_bytes = base64.b64decode(request["Image"]["Bytes"])
+        self._reply(200, cls.detector.detect(image_bytes))
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9001)
+    parser.add_argument(
+        "--latency", type=float, default=300.0, help="simulated DetectFaces latency, ms"
+    )
+    parser.add_argument(
+        "--throttle",
+        type=float,
+        default=0.0,
+        help="share of calls answered ThrottlingException",
+    )
+    parser.add_argument("--samples", default=os.path.join(ROOT, "samples"))
+    args = parser.parse_args()
+
+    FakeRekognitionHandler.detector = ReplayDetector(args.samples)
+    FakeRekognitionHandler.latency = args.latency / 1000
+    FakeRekognitionHandler.throttle = args.throttle
+
+    server = ThreadingHTTPServer((args.host, args.port), FakeRekognitionHandler)
+    print(
+        f"Fake Rekognition on http://{args.host}:{args.port} (throttle {args.throttle:.0%})"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        handler = FakeRekognitionHandler
+        print(f"{handler.calls} call(s), {handler.throttled} throttled")
+
+
+if __name__ == "__main__":
+    main()
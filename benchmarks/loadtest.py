@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+"""Load test of the real Application and ConversationHandler, fully offline.
+
+Builds the bot with `bot.build_application` on top of a fake Telegram HTTP
+backend, then N virtual users go through /start -> Yes -> photo -> numbers
+at the same time. Photos are the bundled samples and the replay detector
+answers with their recorded samples/*.json responses. Every photo sent gets
+distinct bytes (a trailer after the JPEG data), so detections are not all
+served by the content-hash cache; --same-photos measures the cached path.
+
+    python benchmarks/loadtest.py --users 200 --rounds 2
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import itertools
+import statistics
+
+from urllib.parse import urlparse
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SAMPLES = os.path.join(ROOT, "samples")
+WORK_DIR = tempfile.mkdtemp(prefix="loadtest-")
+BOT_TOKEN = "123456:LOADTEST"
+
+# Stand-ins must be configured before the bot modules read the environment
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+os.environ["USAGE_TABLE_BACKEND"] = "memory"
+os.environ["TMP_FOLDER"] = os.path.join(WORK_DIR, "tmp")
+os.environ["DETECTION_CACHE_FOLDER"] = ""
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from telegram import Update  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import bot  # noqa: E402
+import helper_aws  # noqa: E402
+import helper_render  # noqa: E402
+from helper_detectors import ReplayDetector  # noqa: E402
+from helper_metrics import metrics  # noqa: E402
+
+# TELEGRAM BACKEND #############################################################
+
+
+class FakeTelegram(BaseRequest):
+    """Bot API stand-in: answers every call locally and routes replies per chat."""
+
+    def __init__(self, samples: list, latency: float = 0.0, distinct: bool = False):
+        self.latency = latency
+        self.samples = samples
+        self.distinct = distinct
+        self.replies = {}
+        self.calls = {}
+        self._message_ids = itertools.count(1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def inbox(self, chat_id: int) -> asyncio.Queue:
+        return self.replies.setdefault(chat_id, asyncio.Queue())
+
+    def _message(self, chat_id: int, **fields) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+        }
+        message.update(fields)
+        return message
+
+    async def do_request(
+        self,
+        url,
+        method,
+        request_data=None,
+        read_timeout=None,
+        write_timeout=None,
+        connect_timeout=None,
+        pool_timeout=None,
+    ):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        path = urlparse(url).path
+        if "/file/bot" in path:
+            # File download: file paths are "photos/<sample index>/<file_id>.jpg"
+            sample_index = int(path.split("/")[-2])
+            with open(self.samples[sample_index][0], "rb") as image_file:
+                content = image_file.read()
+            if self.distinct:
+                # Decoders stop at the end of the JPEG data, the hash does not
+                content += os.path.basename(path).encode()
+            return 200, content
+
+        endpoint = path.rsplit("/", 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        parameters = request_data.parameters if request_data else {}
+
+        if endpoint == "getMe":
+            result = {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "FaceRemoverBot",
+                "username": "FaceRemoverBot",
+            }
+        elif endpoint == "getFile":
+            file_id = parameters["file_id"]
+            sample_index = file_id.split("-")[1]
+            result = {
+                "file_id": file_id,
+                "file_unique_id": f"u{file_id}",
+                "file_path": f"photos/{sample_index}/{file_id}.jpg",
+            }
+        elif endpoint in ("sendMessage", "sendPhoto", "sendDocument"):
+            chat_id = int(parameters.get("chat_id") or 0)
+            if endpoint == "sendPhoto":
+                fields = {
+                    "photo": [
+                        {
+                            "file_id": "sent",
+                            "file_unique_id": "sent",
+                            "width": 1,
+                            "height": 1,
+                        }
+                    ]
+                }
+            else:
+                fields = {"text": parameters.get("text", "")}
+            result = self._message(chat_id, **fields)
+            self.inbox(chat_id).put_nowait((endpoint, fields))
+        elif endpoint == "sendMediaGroup":
+            chat_id = int(parameters.get("chat_id") or 0)
+            fields = {
+                "photo": [
+                    {
+                        "file_id": "sent",
+                        "file_unique_id": "sent",
+                        "width": 1,
+                        "height": 1,
+                    }
+                ]
+            }
+            result = [self._message(chat_id, **fields) for _ in parameters["media"]]
+            self.inbox(chat_id).put_nowait((endpoint, fields))
+        else:
+            result = True
+
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+# VIRTUAL USERS ################################################################
+
+
+class UpdateFactory:
+    def __init__(self, telegram_bot):
+        self.bot = telegram_bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _update(self, user_id: int, **fields) -> Update:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        }
+        message.update(fields)
+        return Update.de_json(
+            {"update_id": next(self._update_ids), "message": message}, self.bot
+        )
+
+    def command(self, user_id: int, command: str) -> Update:
+        return self._update(
+            user_id,
+            text=command,
+            entities=[{"type": "bot_command", "offset": 0, "length": len(command)}],
+        )
+
+    def text(self, user_id: int, text: str) -> Update:
+        return self._update(user_id, text=text)
+
+    def photo(self, user_id: int, sample_index: int, round_number: int) -> Update:
+        file_id = f"photo-{sample_index}-{user_id}-{round_number}"
+        return self._update(
+            user_id,
+            photo=[
+                {
+                    "file_id": file_id,
+                    "file_unique_id": f"u{file_id}",
+                    "width": 2048,
+                    "height": 1365,
+                }
+            ],
+        )
+
+
+def expect(inbox: asyncio.Queue, endpoint: str, prefix: str) -> None:
+    """Check that the reply ending a step was sent, skipping the chatter before it."""
+    while not inbox.empty():
+        received, fields = inbox.get_nowait()
+        if received == endpoint and fields.get("text", "").startswith(prefix):
+            return
+    raise AssertionError(f"Step ended without a {endpoint} reply {prefix!r}")
+
+
+async def virtual_user(
+    user_id, application, telegram, factory, samples, args, latencies, finished, rng
+):
+    """One user: /start, Yes, then `rounds` times photo + face numbers.
+
+    A step lasts until the bot is done with the update (see `run`), not just
+    until its reply arrived. Like a person, the user reads each answer for a
+    while (`think_time`) before typing the next message.
+    """
+    inbox = telegram.inbox(user_id)
+
+    async def step(name, update, endpoint, prefix=""):
+        start = time.perf_counter()
+        done = finished[update.update_id] = asyncio.get_running_loop().create_future()
+        await application.update_queue.put(update)
+        await asyncio.wait_for(done, args.timeout)
+        latencies.setdefault(name, []).append(time.perf_counter() - start)
+        expect(inbox, endpoint, prefix)
+        await asyncio.sleep(
+            rng.expovariate(1 / args.think_time) if args.think_time else 0
+        )
+
+    await step("start", factory.command(user_id, "/start"), "sendMessage", "Hi!")
+    await step("agree", factory.text(user_id, "Yes"), "sendMessage", "Ok, let's go!")
+    for round_number in range(args.rounds):
+        sample_index = rng.randrange(len(samples))
+        await step(
+            "photo", factory.photo(user_id, sample_index, round_number), "sendPhoto"
+        )
+        faces = len(samples[sample_index][2]["FaceDetails"])
+        numbers = ",".join(
+            str(n) for n in rng.sample(range(1, faces + 1), min(3, faces))
+        )
+        await step(
+            "request",
+            factory.text(user_id, rng.choice([numbers, "all"])),
+            "sendMessage",
+            "Happy to help",
+        )
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def load_samples() -> list:
+    samples = []
+    for json_path in sorted(glob.glob(os.path.join(SAMPLES, "*.jpg.json"))):
+        with open(json_path) as json_file:
+            samples.append(
+                (
+                    json_path[: -len(".json")],
+                    os.path.basename(json_path),
+                    json.load(json_file),
+                )
+            )
+    return samples
+
+
+async def run(args) -> None:
+    samples = load_samples()
+    helper_aws.detector = ReplayDetector(
+        SAMPLES, latency=args.rekognition_latency / 1000
+    )
+    telegram = FakeTelegram(
+        samples, latency=args.telegram_latency / 1000, distinct=not args.same_photos
+    )
+    application = bot.build_application(BOT_TOKEN, telegram_request=telegram)
+    rng = random.Random(args.seed)
+    latencies = {}
+
+    # Last handler group: every other handler is done with the update
+    finished = {}
+
+    async def update_finished(update: Update, context) -> None:
+        done = finished.pop(update.update_id, None)
+        if done is not None and not done.done():
+            done.set_result(None)
+
+    application.add_handler(TypeHandler(Update, update_finished), group=99)
+
+    async with application:
+        await application.start()
+        factory = UpdateFactory(application.bot)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *[
+                virtual_user(
+                    1000 + n,
+                    application,
+                    telegram,
+                    factory,
+                    samples,
+                    args,
+                    latencies,
+                    finished,
+                    random.Random(rng.random()),
+                )
+                for n in range(args.users)
+            ],
+            return_exceptions=True,
+        )
+        elapsed = time.perf_counter() - start
+        await application.stop()
+
+    failures = [result for result in results if isinstance(result, BaseException)]
+    updates = sum(len(values) for values in latencies.values())
+
+    print(
+        f"virtual users       {args.users} x {args.rounds} round(s), {len(failures)} failed"
+    )
+    print(
+        f"updates handled     {updates} in {elapsed:.1f}s -> {updates / elapsed:.1f} updates/s"
+    )
+    print(f"rekognition calls   {helper_aws.detector.calls}")
+    print(f"telegram calls      {telegram.calls}")
+    print()
+    print(
+        f"{'step':<10} {'n':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9} {'mean ms':>9}"
+    )
+    for name in ("start", "agree", "photo", "request"):
+        values = latencies.get(name)
+        if not values:
+            continue
+        print(
+            f"{name:<10} {len(values):>6} {percentile(values, 0.5) * 1000:>9.0f} "
+            f"{percentile(values, 0.9) * 1000:>9.0f} {percentile(values, 0.99) * 1000:>9.0f} "
+            f"{max(values) * 1000:>9.0f} {statistics.mean(values) * 1000:>9.0f}"
+        )
+    print()
+    print("Time spent per stage:")
+    for part in metrics.summary().split(" | "):
+        print(f"  {part}")
+    if failures:
+        print()
+        print(f"First failure: {failures[0]!r}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument(
+        "--rounds", type=int, default=1, help="photo + request cycles per user"
+    )
+    parser.add_argument(
+        "--rekognition-latency",
+        type=float,
+        default=300.0,
+        help="simulated DetectFaces latency, ms",
+    )
+    parser.add_argument(
+        "--telegram-latency",
+        type=float,
+        default=50.0,
+        help="simulated Bot API latency, ms",
+    )
+    parser.add_argument(
+        "--think-time", type=float, default=1.0, help="mean pause between messages, s"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=120.0, help="max wait for one reply, s"
+    )
+    parser.add_argument(
+        "--same-photos",
+        action="store_true",
+        help="send the samples unchanged, detections then mostly hit the cache",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run(args))
+    finally:
+        helper_render.shutdown_render_pool()
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
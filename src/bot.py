@@ -1,31 +1,54 @@
 #!/usr/bin/env python
 
+import io
 import os
 import re
+import asyncio
 import html
 import json
-import boto3
+import time
 import random
 import logging
-import botocore
 import traceback
 
 from dotenv import load_dotenv
 from datetime import datetime
 
-from helper_file import create_folder_if_not_exists, get_file_extension
-from helper_images import generate_reference, generate_blurred
-from helper_aws import detect_faces
+from helper_file import (
+    ExpiryIndex,
+    create_folder_if_not_exists,
+    delete_folder,
+    get_file_extension,
+)
+from helper_images import generate_reference, generate_blurred, render_spec
+from helper_aws import detect_faces, detection_cache
+from helper_cache import SentFileCache
+from helper_render import shutdown_render_pool, warm_up_render_pool
+from helper_store import ORIGINAL, DiskStore, MemoryStore
+from helper_patches import face_patches
+from helper_dynamo import UsageRecorder, create_table
+from helper_metrics import metrics, start_metrics_server
+from helper_admission import AdmissionController, AdmissionRejected, KeyedLock
+from helper_persistence import create_persistence
+from helper_resilience import (
+    DependencyUnavailable,
+    get_breaker,
+    stage_from_env,
+    telegram_retryable,
+)
+from helper_video import clip_supported, generate_anonymized_clip
 
 from telegram import (
     LabeledPrice,
     ShippingOption,
     ForceReply,
+    InputMediaPhoto,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
     ReplyKeyboardRemove,
     Update,
 )
+from telegram.error import BadRequest, TelegramError
 
 from telegram.ext import (
     Application,
@@ -35,11 +58,14 @@ from telegram.ext import (
     MessageHandler,
     PreCheckoutQueryHandler,
     ShippingQueryHandler,
+    TypeHandler,
     filters,
 )
 
 # Enable logging
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
 logger = logging.getLogger(__name__)
 
 # Load environment variables from .env file
@@ -54,15 +80,161 @@ payment_provider_secret = os.getenv("PAYMENT_SECRET")
 donation_stripe_link = os.getenv("DONATION_STRIPE_LINK")
 donation_buymeacoffe_link = os.getenv("DONATION_BUYMEACOFFE_LINK")
 
+# In-memory pipeline: photos never touch the disk unless the memory budget spills
+in_memory_pipeline = os.getenv("IN_MEMORY_PIPELINE", "0") == "1"
+disk_store = DiskStore(
+    budget=int(os.getenv("TMP_FOLDER_BUDGET", str(1024 * 1024 * 1024)))
+)
+photo_store = MemoryStore(
+    budget=int(os.getenv("PHOTO_MEMORY_BUDGET", str(256 * 1024 * 1024))),
+    disk_store=disk_store,
+)
+
+# Updates handled at the same time; one slow photo must not hold other chats.
+# The updates of one user still run one at a time and in order, see
+# UserOrderedApplication: each waiting update holds one of these slots, so a
+# user gets at most USER_MAX_PENDING_UPDATES (an album is up to 10 photos).
+concurrent_updates = int(os.getenv("CONCURRENT_UPDATES", "256"))
+user_max_pending_updates = int(os.getenv("USER_MAX_PENDING_UPDATES", "10"))
+user_updates = KeyedLock()
+_users_flooding = set()
+
+# Album photos arrive as separate updates: they are collected until no new
+# photo of the same media group came for ALBUM_COLLECT_DELAY seconds
+album_collect_delay = float(os.getenv("ALBUM_COLLECT_DELAY", "1.5"))
+pending_albums = {}
+
+# Words choosing the anonymization of one request, e.g. "1,3 pixelate"
+anonymize_keywords = {
+    "blur": "blur",
+    "pixelate": "pixelate",
+    "pixel": "pixelate",
+    "mosaic": "pixelate",
+    "fill": "fill",
+    "black": "fill",
+    "box": "box",
+}
+
+# Admission of the detection and render jobs: bounded, round-robin per user
+admission = AdmissionController(
+    max_active=int(os.getenv("ADMISSION_MAX_ACTIVE", "16")),
+    max_queued=int(os.getenv("ADMISSION_MAX_QUEUED", "200")),
+    max_user_queued=int(os.getenv("ADMISSION_MAX_USER_QUEUED", "3")),
+)
+
+# Serving: long polling, or a webhook behind a load balancer
+bot_mode = os.getenv("BOT_MODE", "polling")
+webhook_url = os.getenv("WEBHOOK_URL")
+webhook_listen = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+webhook_port = int(os.getenv("WEBHOOK_PORT", "8443"))
+webhook_path = os.getenv("WEBHOOK_PATH", "telegram")
+webhook_secret = os.getenv("WEBHOOK_SECRET") or None
+
+# Conversation persistence (PERSISTENCE_BACKEND). With SHARED_STATE=1 several
+# instances share it: each update reloads the user's data and conversation
+# state first and writes them back right after, PTB's periodic writes are off.
+persistence = create_persistence(shared=os.getenv("SHARED_STATE", "0") == "1")
+shared_state = persistence is not None and persistence.shared
+conversation_name = "conversation"
+# Lazy backends (DynamoDB): users whose state this instance already read
+_restored_conversations = set()
+
+# Deadlines and retries of the Bot API calls moving photos around; they
+# share the "telegram" circuit breaker. Uploads are not retried by default:
+# a timed out upload may still have been delivered.
+telegram_get_file = stage_from_env(
+    "telegram_get_file",
+    "telegram",
+    timeout=10,
+    attempts=3,
+    retryable=telegram_retryable,
+)
+telegram_download = stage_from_env(
+    "telegram_download",
+    "telegram",
+    timeout=30,
+    attempts=2,
+    retryable=telegram_retryable,
+)
+telegram_upload = stage_from_env(
+    "telegram_upload", "telegram", timeout=60, attempts=1, retryable=telegram_retryable
+)
+
+# Renders already sent, by (photo file_id, render spec): Telegram keeps them,
+# a repeated request sends the file_id again instead of rendering and uploading
+sent_files = SentFileCache(
+    max_entries=int(os.getenv("SENT_FILE_CACHE_ENTRIES", "4096")),
+    ttl=float(os.getenv("SENT_FILE_CACHE_TTL", str(7 * 24 * 3600))),
+)
+
+# Clips: the Bot API serves downloads up to 20 MB
+telegram_download_limit = 20 * 1024 * 1024
+video_max_duration = float(os.getenv("VIDEO_MAX_DURATION", "60"))
+
+# Metrics: local Prometheus endpoint and periodic summary log (0 disables)
+metrics_port = int(os.getenv("METRICS_PORT", "0"))
+metrics_log_interval = float(os.getenv("METRICS_LOG_INTERVAL", "0"))
+
+# User folders (and their in-memory photos) expire after PHOTO_MAX_AGE seconds
+photo_max_age = float(os.getenv("PHOTO_MAX_AGE", "3600"))
+cleanup_interval = float(os.getenv("CLEANUP_INTERVAL", "60"))
+expiry_index = ExpiryIndex(max_age=photo_max_age)
+
 table_name = os.getenv("BOT_TABLE")
-table = boto3.resource('dynamodb').Table(table_name)
+table = create_table(table_name)
+
+# DynamoDB writes are buffered and flushed in the background
+usage_flush_interval = float(os.getenv("USAGE_FLUSH_INTERVAL", "30"))
+usage_recorder = UsageRecorder(
+    table,
+    max_pending=int(os.getenv("USAGE_FLUSH_SIZE", "100")),
+    breaker=get_breaker("dynamodb"),
+)
+
+metrics.gauge(
+    "detection_cache_hit_ratio",
+    "Share of detections served from the cache.",
+    lambda: detection_cache.stats()["hit_rate"],
+)
+metrics.gauge(
+    "tmp_store_bytes", "Bytes used under TMP_FOLDER.", lambda: disk_store.used
+)
+metrics.gauge(
+    "tmp_store_evictions",
+    "Files evicted to stay within the TMP_FOLDER budget.",
+    lambda: disk_store.evictions,
+)
+metrics.gauge(
+    "memory_store_bytes", "Bytes of photos kept in memory.", lambda: photo_store.used
+)
+metrics.gauge(
+    "usage_pending",
+    "Users with DynamoDB writes waiting for a flush.",
+    lambda: usage_recorder.pending,
+)
+metrics.gauge(
+    "expiry_index_folders", "User folders waiting to expire.", lambda: len(expiry_index)
+)
+metrics.gauge(
+    "admission_active", "Detection and render jobs running.", lambda: admission.active
+)
+metrics.gauge(
+    "admission_queued",
+    "Detection and render jobs waiting for their turn.",
+    lambda: admission.queued,
+)
+metrics.gauge(
+    "sent_file_cache_entries",
+    "Telegram file_ids of sent renders kept for reuse.",
+    lambda: len(sent_files),
+)
 
 AGREE, PHOTO, REQUEST = range(3)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the conversation and asks the user for authorization."""
-    
+
     logger.info("start")
     reply_keyboard = [["Yes", "No"]]
 
@@ -79,9 +251,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         "Say /contribute to know other ways to help and avoid limitations or advertising\n\n"
         "Are ok with this? (Reply or press: Yes or No)",
         reply_markup=ReplyKeyboardMarkup(
-            reply_keyboard,
-            one_time_keyboard=True,
-            input_field_placeholder="Yes or No?"
+            reply_keyboard, one_time_keyboard=True, input_field_placeholder="Yes or No?"
         ),
     )
 
@@ -90,40 +260,31 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def agree(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Stores the selected answer and asks for a photo."""
-    
+
     logger.info("agree")
-    
+
     user = update.message.from_user
     user_id = update.effective_user.id
-    
-    logger.info('>>>>>>>>>>>>>>>>>>>>>>>>>')
+
+    logger.info(">>>>>>>>>>>>>>>>>>>>>>>>>")
     logger.info(user)
     logger.info(user_id)
-    logger.info('>>>>>>>>>>>>>>>>>>>>>>>>>')
-    
-    
+    logger.info(">>>>>>>>>>>>>>>>>>>>>>>>>")
+
     context.user_data["choice"] = True
     now = datetime.now()
 
-    Item={
-        'user_id': str(user['id']),
-        'authorize': True,
-        'registration_time': now.strftime("%H:%M:%S"),
-        'registration_date': now.strftime("%d/%m/%Y"),
-        'count': 0
+    Item = {
+        "user_id": str(user["id"]),
+        "authorize": True,
+        "registration_time": now.strftime("%H:%M:%S"),
+        "registration_date": now.strftime("%d/%m/%Y"),
+        "count": 0,
     }
-    
-    try:
-        table.put_item(
-            Item=Item,
-            ConditionExpression='attribute_not_exists(user_id)'
-        )
-    
-    # Ignore the ConditionalCheckFailedException, bubble up other exceptions.
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
-            raise
-    
+
+    # Conditional put (existing users are kept) done by the next flush
+    usage_recorder.register(Item)
+
     if not "counter" in context.user_data:
         context.user_data["counter"] = 0
 
@@ -136,111 +297,660 @@ async def agree(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return PHOTO
 
 
+async def store_original(photo_file, full_file: str):
+    """Download a photo into the temporary store.
+
+    Returns what detection and rendering read: the bytes in memory mode,
+    the file path otherwise.
+    """
+    if in_memory_pipeline:
+        # Same buffer goes to Rekognition and to the renderers
+        async def download():
+            buffer = io.BytesIO()
+            await photo_file.download_to_memory(buffer)
+            return buffer.getvalue()
+
+        image_source = await telegram_download.call(download)
+        await photo_store.put(full_file, image_source)
+        return image_source
+
+    create_folder_if_not_exists(temporary_folder)
+    create_folder_if_not_exists(os.path.dirname(full_file))
+    await telegram_download.call(photo_file.download_to_drive, full_file)
+    await disk_store.add(full_file, ORIGINAL)
+    return full_file
+
+
+def reference_entry(item: dict, caption: str) -> tuple:
+    """`send_photos` entry of the reference of a prepared photo."""
+
+    async def render():
+        reference_file, _ = await draw_reference(item)
+        return reference_file
+
+    return (item["reference_key"], caption, item["reference_file"], render)
+
+
+def rewind(media):
+    """Photo to send, from its first byte: an upload retry sends the same buffer again."""
+    if hasattr(media, "seek"):
+        media.seek(0)
+    return media
+
+
+async def send_photos(message, entries: list) -> None:
+    """Reply with one photo, or a media group, reusing renders sent before.
+
+    `entries` are (sent_files key, caption, rendered file, render). A file
+    of None sends the file_id remembered under the key, or awaits
+    `render()` when it was evicted meanwhile. When Telegram refuses a
+    remembered file_id, those are forgotten and rendered again, once.
+    """
+    entries = list(entries)
+    for attempt in (1, 2):
+        media = []
+        reused = []
+        for index, (key, caption, photo, render) in enumerate(entries):
+            if photo is None:
+                photo = sent_files.get(key)
+                if photo is None:
+                    photo = await render()
+                    entries[index] = (key, caption, photo, render)
+                else:
+                    reused.append(key)
+            media.append((photo, caption))
+
+        try:
+            with metrics.span("upload"):
+                if len(media) == 1:
+                    photo, caption = media[0]
+                    sent = [
+                        await telegram_upload.call(
+                            lambda: message.reply_photo(
+                                photo=rewind(photo), caption=caption
+                            )
+                        )
+                    ]
+                else:
+                    sent = await telegram_upload.call(
+                        lambda: message.reply_media_group(
+                            media=[
+                                InputMediaPhoto(media=rewind(photo), caption=caption)
+                                for photo, caption in media
+                            ]
+                        )
+                    )
+        except BadRequest as e:
+            if not reused or attempt > 1:
+                raise
+            logger.warning("Sent file_id refused (%s), rendering again", e)
+            for key in reused:
+                sent_files.discard(key)
+            continue
+        break
+
+    metrics.increment("sent_file_reuses", len(reused))
+    for (key, _, _, _), sent_message in zip(entries, sent):
+        if sent_message is not None and sent_message.photo:
+            sent_files.put(key, sent_message.photo[-1].file_id)
+
+    # Tracked once sent, so the budget never evicts a file still to upload
+    if not in_memory_pipeline:
+        for _, _, photo, _ in entries:
+            if photo is not None:
+                await disk_store.add(photo)
+
+
+async def admit(update: Update, user_id: int, notice: str = None):
+    """Admission ticket of a new job, or None when the user was told to retry.
+
+    `notice` is sent to the user once the job is admitted. If a reply
+    fails, the ticket is withdrawn: its slot, or its later turn, is never
+    left to a job that will not run.
+    """
+    try:
+        ticket = admission.enter(user_id)
+    except AdmissionRejected:
+        logger.info("Busy, job of %s rejected", user_id)
+        await update.message.reply_text(
+            "I'm very busy right now, please try again in a few minutes."
+        )
+        return None
+
+    try:
+        if notice:
+            await update.message.reply_text(notice)
+        position = ticket.position
+        if position:
+            await update.message.reply_text(
+                f"You're #{position} in queue, I'll be with you shortly."
+            )
+    except BaseException:
+        admission.withdraw(ticket)
+        raise
+    return ticket
+
+
+async def prepare_photo(photo_size, user_id: int) -> dict:
+    """Download one photo and detect its faces.
+
+    Returns the fields kept in user_data for the follow-up requests, plus the
+    image source and the detected faces.
+    """
+    file_id = photo_size.file_id
+
+    with metrics.span("telegram_get_file"):
+        photo_file = await telegram_get_file.call(photo_size.get_file)
+    extension_file = get_file_extension(photo_file.file_path)
+    path_file = f"{temporary_folder}/{user_id}"
+    full_file = f"{path_file}/{file_id}.{extension_file}"
+
+    with metrics.span("download"):
+        image_source = await store_original(photo_file, full_file)
+    expiry_index.touch(path_file)
+
+    # Call the face detector (or reuse a cached detection of the same photo)
+    with metrics.span("detection"):
+        faces = await detect_faces(
+            image_source, file_unique_id=photo_size.file_unique_id
+        )
+
+    return {
+        "full_file": full_file,
+        "path_file": path_file,
+        "file_id": file_id,
+        "extension_file": extension_file,
+        "faces_count": len(faces),
+        "stored_at": time.time(),
+        "image_source": image_source,
+        "faces": faces,
+    }
+
+
+async def render_reference(item: dict):
+    """Draw the numbered reference, None when it was sent before (see `send_photos`)."""
+    item["reference_key"] = (item["file_id"], render_spec("reference"))
+    if item["reference_key"] in sent_files:
+        return None, dict(enumerate(item["faces"], start=1))
+    return await draw_reference(item)
+
+
+async def draw_reference(item: dict):
+    with metrics.span("reference"):
+        return await generate_reference(
+            image_path=item["image_source"],
+            output_path=None if in_memory_pipeline else item["path_file"],
+            original_filename=item["file_id"],
+            original_extension=item["extension_file"],
+            faces=item["faces"],
+        )
+
+
 async def photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Stores the photo"""
 
     logger.info("photo")
     logger.info("User send a photo.")
-    
+
     if not "choice" in context.user_data:
         await update.message.reply_text(
             "Sorry I need your EXPLICIT authorization before work on your photos.\nSimply use /start to start again.",
             reply_markup=ReplyKeyboardRemove(),
         )
-        
+
         return ConversationHandler.END
 
-    await update.message.reply_text(f"Image received! Look for faces inside.")
-    
+    if update.message.media_group_id:
+        return await album_photo(update, context)
+
     user = update.message.from_user
     user_id = update.effective_user.id
-    file_id = update.message.photo[-1].file_id
 
-    create_folder_if_not_exists(temporary_folder)
-    photo_file = await update.message.photo[-1].get_file()
-    extension_file = get_file_extension(photo_file.file_path)
-    path_file = f"{temporary_folder}/{user_id}"
-    full_file = f"{path_file}/{file_id}.{extension_file}"
-    create_folder_if_not_exists(path_file)
+    ticket = await admit(update, user_id, "Image received! Look for faces inside.")
+    if ticket is None:
+        return None
+
+    async with ticket:
+        item = await prepare_photo(update.message.photo[-1], user_id)
+        logger.info("Photo of %s: %s", user.first_name, item["full_file"])
+        logger.info("Detection cache: %s", detection_cache.stats())
+        logger.info("Temporary store: %s", disk_store.usage())
+
+        # Reply with the number of detected faces
+        faces_count = item["faces_count"]
+        await update.message.reply_text(f"Detected {faces_count} face(s) in the image.")
+
+        photo_data = {
+            key: item[key]
+            for key in (
+                "full_file",
+                "path_file",
+                "file_id",
+                "extension_file",
+                "faces_count",
+                "stored_at",
+            )
+        }
+
+        # if faces_count == 1:
+        #    await update.message.reply_text(f"This is the photo blurred")
+        #    return AGREE
+
+        if faces_count >= 99:
+            await update.message.reply_text(f"Too much faces in this photo")
+        elif faces_count:
+            # generate reference photo
+            item["reference_file"], photo_data["faces_detail"] = await render_reference(
+                item
+            )
+            reference_file = item["reference_file"]
+            photo_data["reference_file"] = (
+                getattr(reference_file, "name", reference_file) or item["file_id"]
+            )
+
+    # Backup ok data: a single photo replaces any previous album or photo, in
+    # one step so the keys of two photos are never mixed
+    context.user_data.pop("album", None)
+    context.user_data.pop("faces_detail", None)
+    context.user_data.update(photo_data)
+    if "faces_detail" not in photo_data:
+        return AGREE
 
-    await photo_file.download_to_drive(full_file)
-    logger.info("Photo of %s: %s", user.first_name, full_file)
+    await send_photos(
+        update.message,
+        [
+            reference_entry(
+                item,
+                "Use the numbers in the to receive a copy with these faces blurred, or type 'all'",
+            )
+        ],
+    )
 
-    # Call Amazon Rekognition
-    api_response = await detect_faces(full_file)
+    return REQUEST
 
-    with open(f"{full_file}.json", "w") as json_file:
-        json.dump(api_response, json_file, indent=4)
 
-    # Reply with the number of detected faces
-    faces = api_response["FaceDetails"]
-    faces_count = len(faces)
-    await update.message.reply_text(f"Detected {faces_count} face(s) in the image.")
+# ALBUMS #######################################################################
 
-    context.user_data["full_file"] = full_file
-    context.user_data["path_file"] = path_file
-    context.user_data["file_id"] = file_id
-    context.user_data["extension_file"] = extension_file
-    context.user_data["api_response"] = api_response
-    context.user_data["faces_count"] = faces_count
 
-    if faces_count == 0:
-        return AGREE
+async def prepare_album_photo(photo_size, user_id: int, ticket) -> dict:
+    """Detection and reference of one album photo, run as soon as admitted."""
+    async with ticket:
+        item = await prepare_photo(photo_size, user_id)
+        item["reference_key"] = item["reference_file"] = None
+        item["faces_detail"] = {}
+        if 0 < item["faces_count"] < 99:
+            item["reference_file"], item["faces_detail"] = await render_reference(item)
+    return item
 
-    # if faces_count == 1:
-    #    await update.message.reply_text(f"This is the photo blurred")
-    #    return AGREE
 
-    if faces_count >= 99:
-        await update.message.reply_text(f"Too much faces in this photo")
-        return AGREE
+async def album_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Collect one photo of an album; the whole album is answered at once.
 
-    # generate reference photo
-    reference_file, faces_detail = await generate_reference(
-        image_path=full_file,
-        output_path=path_file,
-        original_filename=file_id,
-        original_extension=extension_file,
-        api_response=api_response,
+    Every photo starts its download, detection and reference right away, so
+    the photos of an album are processed concurrently. `process_album` runs
+    once no new photo of the group arrived for `album_collect_delay`.
+    """
+    user_id = update.effective_user.id
+    key = (user_id, update.message.media_group_id)
+
+    album = pending_albums.get(key)
+    if album is None:
+        album = pending_albums[key] = {
+            "message": update.message,
+            "tasks": [],
+            "job": None,
+        }
+        context.user_data["album_pending"] = True
+        await update.message.reply_text("Album received! Look for faces inside.")
+
+    # Each photo is its own job, rejected ones are left out of the album
+    ticket = await admit(update, user_id)
+    if ticket is not None:
+        task = asyncio.ensure_future(
+            prepare_album_photo(update.message.photo[-1], user_id, ticket)
+        )
+        album["tasks"].append((update.message.message_id, task))
+
+    if album["job"] is not None:
+        album["job"].schedule_removal()
+    album["job"] = context.job_queue.run_once(
+        process_album,
+        album_collect_delay,
+        data=key,
+        chat_id=update.effective_chat.id,
+        user_id=user_id,
     )
 
-    # Backup ok data
-    context.user_data["reference_file"] = reference_file
-    context.user_data["faces_detail"] = faces_detail
+    return REQUEST
+
+
+async def process_album(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job answering a collected album with one media group of references."""
+    album = pending_albums.pop(context.job.data)
+    message = album["message"]
+
+    tasks = [task for _, task in sorted(album["tasks"], key=lambda entry: entry[0])]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    items = []
+    failures = []
+    for result in results:
+        if isinstance(result, BaseException):
+            logger.error("Album photo failed: %s", result)
+            failures.append(result)
+            continue
+        items.append(result)
 
-    await update.message.reply_photo(
-        photo=reference_file,
-        caption="Use the numbers in the to receive a copy with these faces blurred, or type 'all'",
+    references = [
+        (number, item)
+        for number, item in enumerate(items, start=1)
+        if item["reference_key"] is not None
+    ]
+
+    # Written between two updates of the user, never in the middle of one
+    async with user_updates.hold(context.job.user_id):
+        if failures and not items:
+            # Nothing to show: the error handler tells the user what happened
+            context.user_data["album_pending"] = False
+            if shared_state:
+                await persistence.store_user_data(
+                    context.job.user_id, context.user_data
+                )
+            raise failures[0]
+
+        # Only what the follow-up requests need is kept, in album order
+        context.user_data["album"] = [
+            {
+                key: item[key]
+                for key in (
+                    "full_file",
+                    "path_file",
+                    "file_id",
+                    "extension_file",
+                    "faces_count",
+                    "stored_at",
+                    "faces_detail",
+                )
+            }
+            for item in items
+        ]
+        context.user_data["album_pending"] = False
+        if references:
+            last_reference = references[-1][1]
+            context.user_data["reference_file"] = (
+                getattr(
+                    last_reference["reference_file"],
+                    "name",
+                    last_reference["reference_file"],
+                )
+                or last_reference["file_id"]
+            )
+        if shared_state:
+            await persistence.store_user_data(context.job.user_id, context.user_data)
+
+    faces_total = sum(item["faces_count"] for item in items)
+    await message.reply_text(
+        f"Detected {faces_total} face(s) in {len(items)} photo(s)."
     )
+    if not references:
+        return
 
-    return REQUEST
+    await send_photos(
+        message,
+        [reference_entry(item, f"Photo {number}") for number, item in references],
+    )
+    await message.reply_text(
+        "Tell me the photo and the faces to blur, like 2:1,3 (several photos: 1:2; 3:all), or type 'all'"
+    )
+
+
+# CLIPS ########################################################################
+
+
+async def clip(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Anonymize every face of a video or an animation (GIF).
+
+    Faces cannot be picked by number across frames, so all of them are
+    anonymized, in the mode named in the caption if any. The conversation
+    stays where it was.
+    """
+    logger.info("clip")
+
+    if not "choice" in context.user_data:
+        await update.message.reply_text(
+            "Sorry I need your EXPLICIT authorization before work on your photos.\nSimply use /start to start again.",
+            reply_markup=ReplyKeyboardRemove(),
+        )
+        return ConversationHandler.END
+
+    user_id = update.effective_user.id
+    media = update.message.animation or update.message.video
+
+    if not clip_supported(media.mime_type):
+        await update.message.reply_text(
+            "Sorry, I can only work on GIF animations for now."
+        )
+        return None
+    if (media.file_size or 0) > telegram_download_limit or (
+        media.duration or 0
+    ) > video_max_duration:
+        await update.message.reply_text(
+            f"Sorry, this clip is too big for me: up to {video_max_duration:g} seconds and 20 MB please."
+        )
+        return None
+
+    mode, _ = split_anonymize_mode(update.message.caption or "")
+
+    ticket = await admit(
+        update, user_id, "Clip received! Looking for faces, this can take a moment."
+    )
+    if ticket is None:
+        return None
+
+    async with ticket:
+        with metrics.span("telegram_get_file"):
+            clip_file = await telegram_get_file.call(media.get_file)
+        extension_file = get_file_extension(clip_file.file_path)
+        path_file = f"{temporary_folder}/{user_id}"
+        full_file = f"{path_file}/{media.file_id}.{extension_file}"
+
+        with metrics.span("download"):
+            clip_source = await store_original(clip_file, full_file)
+        expiry_index.touch(path_file)
+
+        with metrics.span("video"):
+            blurried_clip, faces_max = await generate_anonymized_clip(
+                clip_source,
+                output_path=None if in_memory_pipeline else path_file,
+                original_filename=media.file_id,
+                original_extension=extension_file,
+                mode=mode,
+            )
+
+    if blurried_clip is None:
+        await update.message.reply_text("I couldn't find any face in this clip.")
+        return None
+
+    caption = f"Your clip with faces removed! (up to {faces_max} face(s) at once)"
+    with metrics.span("upload"):
+        if update.message.animation:
+            await telegram_upload.call(
+                lambda: update.message.reply_animation(
+                    animation=rewind(blurried_clip), caption=caption
+                )
+            )
+        else:
+            await telegram_upload.call(
+                lambda: update.message.reply_video(
+                    video=rewind(blurried_clip), caption=caption
+                )
+            )
+    if not in_memory_pipeline:
+        await disk_store.add(blurried_clip)
+
+    context.user_data["counter"] += 1
+    usage_recorder.increment(str(user_id))
+
+    # A little advertising
+    counter = int(context.user_data["counter"])
+    await update.message.reply_text(
+        f"Happy to help you with those {counter} photos!\nDo you consider to help me by /donate or /contribute ?"
+    )
+    return None
+
+
+def split_anonymize_mode(text: str) -> tuple:
+    """Anonymization mode asked in a request (None for the default) and the rest of the text."""
+    mode = None
+    words = []
+    for word in text.split():
+        if word.lower() in anonymize_keywords:
+            mode = anonymize_keywords[word.lower()]
+        else:
+            words.append(word)
+    return mode, " ".join(words)
+
+
+def parse_album_request(text: str, album: list) -> dict:
+    """Album follow-up ("2:1,3", "1:all; 3:2" or "all") as {photo index: [face ids]}."""
+    requested = {}
+    if text.strip().upper() == "ALL":
+        for index, item in enumerate(album):
+            if item["faces_detail"]:
+                requested[index] = sorted(item["faces_detail"])
+        return requested
+
+    # Each "<photo>:" owns the text up to the next one: ["", "2", "1,3 ", "3", "all"]
+    parts = re.split(r"(\d+)\s*:", text)
+    for photo_number, faces in zip(parts[1::2], parts[2::2]):
+        index = int(photo_number) - 1
+        if not 0 <= index < len(album) or not album[index]["faces_detail"]:
+            continue
+        keys = album[index]["faces_detail"].keys()
+        if faces.strip(" ,;").upper() == "ALL":
+            ids = sorted(keys)
+        else:
+            ids = [
+                int(candidate)
+                for candidate in re.findall(r"\d+", faces)
+                if int(candidate) in keys
+            ]
+        if ids:
+            # Same face asked twice is blurred once, in the order first asked
+            requested[index] = list(dict.fromkeys(requested.get(index, []) + ids))
+    return requested
+
+
+async def load_original(context: ContextTypes.DEFAULT_TYPE, item: dict):
+    """The original of a photo from the temporary store, or None once expired.
+
+    A photo missing here but not expired yet (evicted to free space, stored
+    by another instance or before a restart) is fetched again from Telegram
+    by its file_id.
+    """
+    image_path = item["full_file"]
+    if in_memory_pipeline:
+        image_source = await photo_store.get(image_path)
+    elif os.path.exists(image_path):
+        disk_store.touch(image_path)
+        image_source = image_path
+    else:
+        image_source = None
+
+    recent = time.time() - item.get("stored_at", 0) < photo_max_age
+    if image_source is None and (recent or disk_store.was_evicted(image_path)):
+        logger.info("Restoring photo %s", image_path)
+        photo_file = await telegram_get_file.call(context.bot.get_file, item["file_id"])
+        image_source = await store_original(photo_file, image_path)
+
+    return image_source
+
+
+async def blur_photo(item: dict, image_source, ids_requested: list, mode: str = None):
+    """Copy of one photo with the requested faces anonymized."""
+    faces_detail = item["faces_detail"]
+    with metrics.span("patches"):
+        patches = await face_patches.get(
+            item["file_id"],
+            image_source,
+            [faces_detail[face_id] for face_id in sorted(faces_detail)],
+            mode,
+            folder=item["path_file"],
+        )
+
+    with metrics.span("blur"):
+        blurried_photo = await generate_blurred(
+            image_path=image_source,
+            output_path=None if in_memory_pipeline else item["path_file"],
+            original_filename=item["file_id"],
+            original_extension=item["extension_file"],
+            faces_detail=item["faces_detail"],
+            ids_requested=ids_requested,
+            face_patches=patches,
+            mode=mode,
+        )
+
+    expiry_index.touch(item["path_file"])
+    return blurried_photo
+
+
+def blurred_key(item: dict, ids_requested: list, mode: str = None) -> tuple:
+    return (item["file_id"], render_spec("anonymized", mode, ids_requested))
+
+
+def blurred_entry(
+    context,
+    item: dict,
+    ids_requested: list,
+    mode: str,
+    caption: str,
+    blurried_photo=None,
+) -> tuple:
+    """`send_photos` entry of an anonymized photo, rendered again from the original if needed."""
+
+    async def render():
+        image_source = await load_original(context, item)
+        if image_source is None:
+            raise FileNotFoundError(f"Original of {item['file_id']} expired")
+        return await blur_photo(item, image_source, ids_requested, mode)
+
+    return (blurred_key(item, ids_requested, mode), caption, blurried_photo, render)
 
 
 async def request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    
-    logger.info('request')
+
+    logger.info("request")
     logger.info("User ask a request.")
-    
+
     user = update.message.from_user
     user_id = update.effective_user.id
-    
-    logger.info('>>>>>>>>>>>>>>>>>>>>>>>>>')
+
+    logger.info(">>>>>>>>>>>>>>>>>>>>>>>>>")
     logger.info(user)
     logger.info(user_id)
-    logger.info('>>>>>>>>>>>>>>>>>>>>>>>>>')
-    
-    # Parse numbers
-    image_path=context.user_data["full_file"]
-    if not os.path.exists(image_path):
+    logger.info(">>>>>>>>>>>>>>>>>>>>>>>>>")
+
+    if context.user_data.get("album_pending"):
         await update.message.reply_text(
-            "Your photo has been deleted for inactivity, please upload again.\n"
-            "All photographs are automatically deleted on a regular basis."
+            "I'm still working on your album, one moment please."
         )
         return REQUEST
 
+    mode, text = split_anonymize_mode(update.message.text)
+
+    if "album" in context.user_data:
+        return await album_request(update, context, text, mode)
+
+    if "faces_detail" not in context.user_data:
+        await update.message.reply_text(
+            "Please send me a photo with some faces to work on it"
+        )
+        return PHOTO
+
+    # Parse numbers
     valid_numbers = []
-    raw_numbers = update.message.text
-    candidate_numbers = re.findall(r"[\d']+", update.message.text)
+    raw_numbers = text
+    candidate_numbers = re.findall(r"[\d']+", text)
 
     keys = context.user_data["faces_detail"].keys()
     for candidate in candidate_numbers:
@@ -249,57 +959,158 @@ async def request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     # Option to use keyword: ALL
     end_number = context.user_data["faces_count"]
-    if raw_numbers.upper() == 'ALL':
+    if raw_numbers.upper() == "ALL":
         valid_numbers = [i for i in range(1, end_number + 1)]
 
     # Error non valid number
     if not len(valid_numbers):
         await update.message.reply_text(
             "Give a list number like: 1,2,3... and I'll give you a copy of the photo with these faces blurried.\n"
-            "You can also type: all"
+            "You can also type: all, and add pixelate, fill or box for another look than blur"
         )
-        
+
         return REQUEST
-    
+
     # Everything OK => generate images
     await update.message.reply_text(
         f"The valid references numbers are: {str(valid_numbers)[1:-1]}"
     )
 
-    blurried_photo = await generate_blurred(
-        image_path=context.user_data["full_file"],
-        output_path=context.user_data["path_file"],
-        original_filename=context.user_data["file_id"],
-        original_extension=context.user_data["extension_file"],
-        faces_detail=context.user_data["faces_detail"],
-        ids_requested=valid_numbers,
+    # Sent before: Telegram still has it, nothing to load or render
+    blurried_photo = None
+    if blurred_key(context.user_data, valid_numbers, mode) not in sent_files:
+        image_source = await load_original(context, context.user_data)
+
+        if image_source is None:
+            await update.message.reply_text(
+                "Your photo has been deleted for inactivity, please upload again.\n"
+                "All photographs are automatically deleted on a regular basis."
+            )
+            return REQUEST
+
+        ticket = await admit(update, user_id)
+        if ticket is None:
+            return REQUEST
+        async with ticket:
+            blurried_photo = await blur_photo(
+                context.user_data, image_source, valid_numbers, mode
+            )
+
+    await send_photos(
+        update.message,
+        [
+            blurred_entry(
+                context,
+                context.user_data,
+                valid_numbers,
+                mode,
+                "Your photo with faces removed!",
+                blurried_photo,
+            )
+        ],
     )
 
-    await update.message.reply_photo(
-        photo=blurried_photo,
-        caption="Your photo with faces removed!"
-    )
-    
     context.user_data["counter"] += 1
-    table.update_item(
-        Key={ 'user_id': str(user_id), }, 
-        UpdateExpression="SET #count = #count + :increment",
-		ExpressionAttributeNames={"#count": "count"},
-		ExpressionAttributeValues={":increment": 1 }
+    usage_recorder.increment(str(user_id))
+
+    # A little advertising
+    counter = int(context.user_data["counter"])
+    await update.message.reply_text(
+        f"Happy to help you with those {counter} photos!\nDo you consider to help me by /donate or /contribute ?"
     )
-    
+
+    return REQUEST
+
+
+async def album_request(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, mode: str = None
+) -> int:
+    """Anonymize the requested faces of several album photos, answered as one media group."""
+    user_id = update.effective_user.id
+    album = context.user_data["album"]
+
+    requested = parse_album_request(text, album)
+    if not requested:
+        await update.message.reply_text(
+            "Give the photo and the face numbers like: 2:1,3 (several photos: 1:2; 3:all) "
+            "and I'll give you copies with these faces blurried.\n"
+            "You can also type: all, and add pixelate, fill or box for another look than blur"
+        )
+        return REQUEST
+
+    await update.message.reply_text(
+        "The valid references numbers are: "
+        + "; ".join(
+            f"{index + 1}:{str(ids)[1:-1]}" for index, ids in sorted(requested.items())
+        )
+    )
+
+    # Only the photos never sent this way are loaded and rendered
+    blurried_photos = {}
+    missing = [
+        index
+        for index, ids in requested.items()
+        if blurred_key(album[index], ids, mode) not in sent_files
+    ]
+    if missing:
+        sources = await asyncio.gather(
+            *[load_original(context, album[index]) for index in missing]
+        )
+        if any(source is None for source in sources):
+            await update.message.reply_text(
+                "Your photos have been deleted for inactivity, please upload again.\n"
+                "All photographs are automatically deleted on a regular basis."
+            )
+            return REQUEST
+
+        ticket = await admit(update, user_id)
+        if ticket is None:
+            return REQUEST
+        async with ticket:
+            rendered = await asyncio.gather(
+                *[
+                    blur_photo(album[index], source, requested[index], mode)
+                    for index, source in zip(missing, sources)
+                ]
+            )
+        blurried_photos = dict(zip(missing, rendered))
+
+    await send_photos(
+        update.message,
+        [
+            blurred_entry(
+                context,
+                album[index],
+                ids,
+                mode,
+                (
+                    "Your photo with faces removed!"
+                    if len(requested) == 1
+                    else f"Photo {index + 1}"
+                ),
+                blurried_photos.get(index),
+            )
+            for index, ids in requested.items()
+        ],
+    )
+
+    context.user_data["counter"] += len(requested)
+    usage_recorder.increment(str(user_id), len(requested))
+
     # A little advertising
     counter = int(context.user_data["counter"])
-    await update.message.reply_text(f"Happy to help you with those {counter} photos!\nDo you consider to help me by /donate or /contribute ?")
+    await update.message.reply_text(
+        f"Happy to help you with those {counter} photos!\nDo you consider to help me by /donate or /contribute ?"
+    )
 
     return REQUEST
 
 
 async def give_excuse(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    
-    logger.info('give_excuse')
-    
-    if ("choice" in context.user_data and "reference_file" in context.user_data):
+
+    logger.info("give_excuse")
+
+    if "choice" in context.user_data and "reference_file" in context.user_data:
         await update.message.reply_text("I'm not sure if I understand you")
         return REQUEST
 
@@ -308,8 +1119,8 @@ async def give_excuse(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancels and ends the conversation."""
-    
-    logger.info('cancel')
+
+    logger.info("cancel")
 
     context.user_data["choice"] = False
     user = update.message.from_user
@@ -325,9 +1136,10 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 # INFO #########################################################################
 
+
 async def show_data_info(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-    
-    logger.info('show_data_info')
+
+    logger.info("show_data_info")
     await update.message.reply_text(
         "*Notice on image processing*:\n\n"
         "This Telegram bot is designed solely for automatic image processing purposes. We want to assure you that your images are treated with the utmost respect for your privacy and security.\n\n"
@@ -336,20 +1148,45 @@ async def show_data_info(update: object, context: ContextTypes.DEFAULT_TYPE) ->
         "- *Data Security:* While we take every possible precaution to safeguard your data, please be aware that no online platform is completely immune to potential security risks. By using this bot, you acknowledge and accept this inherent risk.\n"
         "- *No Guarantees:* While we strive for accurate and reliable image analysis, we cannot guarantee the absolute accuracy or completeness of the results. It is advisable to use this bot's outputs as a reference and not as the sole basis for important decisions.\n\n"
         "By using this Telegram bot, you consent to the terms outlined in this disclaimer. If you have any concerns about your privacy or the handling of your data, please refrain from using the bot. Your trust and privacy are of utmost importance to us.\n",
-        parse_mode="markdown"
+        parse_mode="markdown",
     )
 
+
 # ERROR ########################################################################
 
-async def ask_for_permission(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-    logger.info('ask_for_permission')
-    await update.message.reply_text("I need your explicit permission to work, type or press /start")
-    
+
+async def ask_for_permission(
+    update: object, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    logger.info("ask_for_permission")
+    await update.message.reply_text(
+        "I need your explicit permission to work, type or press /start"
+    )
+
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log the error and send a telegram message to notify the developer."""
-    
-    logger.info('error_handler')
+
+    logger.info("error_handler")
+
+    # Background jobs, like albums, have no update
+    if isinstance(update, Update) and update.effective_chat:
+        chat_id = update.effective_chat.id
+    else:
+        chat_id = context.job.chat_id if context.job else None
+
+    # A slow or failing dependency is not a bug: apologize, don't page the developer
+    if isinstance(context.error, DependencyUnavailable):
+        logger.warning("Dependency unavailable for %s: %s", chat_id, context.error)
+        if chat_id is not None:
+            try:
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    text="Sorry, I'm having trouble with one of my services right now. Please try again in a few minutes.",
+                )
+            except TelegramError as e:
+                logger.warning("Could not apologize to %s: %s", chat_id, e)
+        return
 
     now = datetime.now()
     current_time = now.strftime("%H:%M:%S")
@@ -364,51 +1201,54 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     logger.error("<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<")
 
     # Finally, send the message
-    error_message = (
-        f"$> Error with user {update_str['message']['chat']['id']} at {current_time}"
-    )
+    error_message = f"$> Error with user {chat_id} at {current_time}"
 
     await context.bot.send_message(chat_id=developer_chat_id, text=error_message)
 
 
 # DONATE #######################################################################
 
+
 async def mention_other_ways(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
-    
-    logger.info('mention_other_ways')
+
+    logger.info("mention_other_ways")
     chat_id = update.message.chat_id
-    
-    random_gifs=[
-        'https://media1.giphy.com/media/R6gvnAxj2ISzJdbA63/giphy.gif',
-        'https://media0.giphy.com/media/aPN2C7ZONEwEe5PNXj/giphy.gif',
-        'https://media3.giphy.com/media/1oibnUaGm5czffacN4/giphy.gif',
-        'https://media3.giphy.com/media/iaRIvwgdg5qwT40iDL/giphy.gif',
-        'https://media1.giphy.com/media/UQOtfc9uIXVv9IidCD/giphy.gif',
-        'https://media4.giphy.com/media/lqMxLjlpyAaAjfJ9yj/giphy.gif',
-        'https://media4.giphy.com/media/RghVmNiqzUNRDsjw8k/giphy.gif',
-        'https://media1.giphy.com/media/3ohzgMvITPaFeQaSfm/giphy.gif',
-        'https://media2.giphy.com/media/dBTJJqrcXMBgMhyE0d/giphy.gif',
-        'https://media2.giphy.com/media/Wz2hmNYVM2LtGOGTAD/giphy.gif',
+
+    random_gifs = [
+        "https://media1.giphy.com/media/R6gvnAxj2ISzJdbA63/giphy.gif",
+        "https://media0.giphy.com/media/aPN2C7ZONEwEe5PNXj/giphy.gif",
+        "https://media3.giphy.com/media/1oibnUaGm5czffacN4/giphy.gif",
+        "https://media3.giphy.com/media/iaRIvwgdg5qwT40iDL/giphy.gif",
+        "https://media1.giphy.com/media/UQOtfc9uIXVv9IidCD/giphy.gif",
+        "https://media4.giphy.com/media/lqMxLjlpyAaAjfJ9yj/giphy.gif",
+        "https://media4.giphy.com/media/RghVmNiqzUNRDsjw8k/giphy.gif",
+        "https://media1.giphy.com/media/3ohzgMvITPaFeQaSfm/giphy.gif",
+        "https://media2.giphy.com/media/dBTJJqrcXMBgMhyE0d/giphy.gif",
+        "https://media2.giphy.com/media/Wz2hmNYVM2LtGOGTAD/giphy.gif",
     ]
-    
+
     await update.message.reply_text(f"Thanks for considering help!")
     await context.bot.send_document(
-        chat_id=chat_id,
-        document=random.choice(random_gifs))
-    
-    await update.message.reply_text(f"By the moment the alternative ways to donate are:")
+        chat_id=chat_id, document=random.choice(random_gifs)
+    )
+
+    await update.message.reply_text(
+        f"By the moment the alternative ways to donate are:"
+    )
     await update.message.reply_text(f"Stripe donation link: {donation_stripe_link}")
-    await update.message.reply_text(f"BuyMe a Coffe Donation link: {donation_buymeacoffe_link}")
+    await update.message.reply_text(
+        f"BuyMe a Coffe Donation link: {donation_buymeacoffe_link}"
+    )
 
 
 async def start_without_shipping_callback(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     """Sends an invoice without shipping-payment."""
-    logger.info('start_without_shipping_callback')
-    
+    logger.info("start_without_shipping_callback")
+
     chat_id = update.message.chat_id
     title = "Multi Face Remover 1 USD Donation"
     description = "Your privacy is our top priority.\n\nWhen you make a donation to support our identity protection bot, you can be confident that your transaction is secure. We've partnered with trusted platforms like Stripe and Telegram to manage your donation securely."
@@ -419,24 +1259,18 @@ async def start_without_shipping_callback(
     # price in dollars
     currency = "USD"
     price = 1
-    
+
     # price * 100 so as to include 2 decimal points
     prices = [LabeledPrice("Contribution", price * 100)]
 
-    # optionally pass 
+    # optionally pass
     # need_name=True
     # need_phone_number=True,
     # need_email=True
     # need_shipping_address=True
     # is_flexible=True
     await context.bot.send_invoice(
-        chat_id,
-        title,
-        description,
-        payload,
-        payment_provider_token,
-        currency,
-        prices
+        chat_id, title, description, payload, payment_provider_token, currency, prices
     )
 
 
@@ -445,8 +1279,8 @@ async def precheckout_callback(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     """Answers the PreQecheckoutQuery"""
-    logger.info('precheckout_callback')
-    
+    logger.info("precheckout_callback")
+
     query = update.pre_checkout_query
     # check the payload, is this from your bot?
     if query.invoice_payload != payment_provider_secret:
@@ -461,8 +1295,8 @@ async def successful_payment_callback(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     """Confirms the successful payment."""
-    logger.info('successful_payment_callback')
-    
+    logger.info("successful_payment_callback")
+
     # do something after successfully receiving payment?
     await update.message.reply_text("Thank you for your help!")
     context.user_data["counter"] = -99
@@ -471,17 +1305,193 @@ async def successful_payment_callback(
 # ##############################################################################
 
 
-def main() -> None:
-    """Start the bot."""
+async def flush_usage(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Periodic job writing the buffered registrations and counters."""
+    await usage_recorder.flush()
 
-    if bot_token is None:
-        logger.error("Bot token not found in environment variable.")
+
+async def cleanup_expired(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Periodic job deleting the user folders that are due, and only those.
+
+    It also prunes the disk tier of the detection cache.
+    """
+    for folder_path in expiry_index.pop_due():
+        photo_store.discard_folder(folder_path)
+        face_patches.discard_folder(folder_path)
+        disk_store.forget_folder(folder_path)
+        await asyncio.to_thread(delete_folder, folder_path)
+    await asyncio.to_thread(detection_cache.prune)
+
+
+async def log_metrics(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Periodic job writing a one-line metrics summary to the log."""
+    logger.info("Metrics: %s", metrics.summary())
+
+
+async def post_init(application: Application) -> None:
+    """Index what previous runs left in the temporary folder, start the render pool."""
+    logger.info("post_init")
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    await asyncio.to_thread(expiry_index.rebuild, temporary_folder)
+    await asyncio.to_thread(disk_store.rebuild, temporary_folder)
+    await disk_store.enforce()
+    await warm_up_render_pool()
+
+
+# SHARED STATE #################################################################
+
+
+def _conversation_key(update: Update) -> tuple:
+    # Same key as the ConversationHandler (per chat and per user)
+    return (update.effective_chat.id, update.effective_user.id)
+
+
+def _conversation_states(application: Application):
+    """States of the persistent ConversationHandler, read at startup only by the handler."""
+    for handler in application.handlers.get(0, []):
+        if (
+            isinstance(handler, ConversationHandler)
+            and handler.name == conversation_name
+        ):
+            return handler._conversations
+
+
+async def load_shared_state(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Before the handlers: take the user's data and conversation state from the shared store.
+
+    Another instance may have handled the previous message of this user.
+    """
+    if (
+        not isinstance(update, Update)
+        or not update.effective_user
+        or not update.effective_chat
+    ):
+        return
+
+    await _read_state(update, context)
+
+
+async def _read_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_data = await persistence.load_user_data(update.effective_user.id)
+    if user_data is not None:
+        context.user_data.clear()
+        context.user_data.update(user_data)
+
+    key = _conversation_key(update)
+    state = await persistence.load_conversation(conversation_name, key)
+    conversations = _conversation_states(context.application)
+    if state is None:
+        conversations.data.pop(key, None)
+    else:
+        conversations.update_no_track({key: state})
+
+
+async def restore_state(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Before the handlers, single instance on a lazy backend: read the state of a
+    user on their first update, instead of scanning the whole store at startup.
+    """
+    if (
+        not isinstance(update, Update)
+        or not update.effective_user
+        or not update.effective_chat
+    ):
+        return
+
+    key = _conversation_key(update)
+    if key in _restored_conversations:
+        return
+    await _read_state(update, context)
+    _restored_conversations.add(key)
+
+
+async def store_shared_state(
+    update: object, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    """After the handlers: write the user's data and conversation state back at once."""
+    if (
+        not isinstance(update, Update)
+        or not update.effective_user
+        or not update.effective_chat
+    ):
         return
 
+    key = _conversation_key(update)
+    await persistence.store_user_data(update.effective_user.id, context.user_data)
+    await persistence.store_conversation(
+        conversation_name, key, _conversation_states(context.application).get(key)
+    )
+
+
+async def post_shutdown(application: Application) -> None:
+    """Write what is still buffered and release the worker pools."""
+    logger.info("post_shutdown")
+    await usage_recorder.flush()
+    shutdown_render_pool()
+
+
+class UserOrderedApplication(Application):
+    """Updates of different users run concurrently, those of one user in order.
+
+    A text sent while a photo is still processed waits for it instead of
+    reaching the conversation in the wrong state, and two photos never
+    write their user_data at the same time. Beyond USER_MAX_PENDING_UPDATES
+    waiting updates, those of the user are dropped with one notice.
+    """
+
+    async def process_update(self, update: object) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await super().process_update(update)
+            return
+        if user_updates.pending(user.id) >= user_max_pending_updates:
+            await self.drop_update(update)
+            return
+        async with user_updates.hold(user.id):
+            await super().process_update(update)
+        if not user_updates.pending(user.id):
+            _users_flooding.discard(user.id)
+
+    async def drop_update(self, update: Update) -> None:
+        user_id = update.effective_user.id
+        metrics.increment("updates_dropped")
+        logger.warning(f"Too many pending updates from {user_id}, dropping one")
+        if user_id in _users_flooding or not update.effective_chat:
+            return
+        _users_flooding.add(user_id)
+        try:
+            await self.bot.send_message(
+                update.effective_chat.id,
+                "Too many messages at once, I skipped some of them. Send them again once I'm done with these.",
+            )
+        except TelegramError as e:
+            logger.warning(f"Unable to warn {user_id} about skipped messages: {str(e)}")
+
+
+def build_application(token: str, telegram_request=None) -> Application:
+    """Create the Application with every handler and background job.
+
+    `telegram_request` replaces the HTTP backend used to talk to Telegram (load tests).
+    """
+
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(bot_token).build()
+    builder = (
+        Application.builder()
+        .application_class(UserOrderedApplication)
+        .token(token)
+        .concurrent_updates(concurrent_updates)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if telegram_request is not None:
+        builder = builder.request(telegram_request).get_updates_request(
+            telegram_request
+        )
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    application = builder.build()
 
-    #random_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), give_excuse)
+    # random_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), give_excuse)
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
@@ -489,33 +1499,89 @@ def main() -> None:
                 MessageHandler(filters.Regex("^(Yes|yes|YES|Y|y)$"), agree),
                 MessageHandler(filters.Regex("^(No|NO|no|N|n)$"), cancel),
             ],
-            PHOTO: [MessageHandler(filters.PHOTO, photo)],
+            PHOTO: [
+                MessageHandler(filters.PHOTO, photo),
+                MessageHandler(filters.VIDEO | filters.ANIMATION, clip),
+            ],
             REQUEST: [MessageHandler(filters.TEXT & ~filters.COMMAND, request)],
         },
         fallbacks=[
             MessageHandler(filters.PHOTO, photo),
+            MessageHandler(filters.VIDEO | filters.ANIMATION, clip),
             MessageHandler(filters.TEXT & ~filters.COMMAND, give_excuse),
             CommandHandler("cancel", cancel),
         ],
+        name=conversation_name,
+        persistent=persistence is not None,
     )
 
     # Business Logic handlers
     application.add_handler(conv_handler)
-    application.add_handler(MessageHandler(filters.PHOTO, ask_for_permission))
+    application.add_handler(
+        MessageHandler(
+            filters.PHOTO | filters.VIDEO | filters.ANIMATION, ask_for_permission
+        )
+    )
     application.add_handler(CommandHandler("data", show_data_info))
 
     # Donation handlers
     application.add_handler(CommandHandler("contribute", mention_other_ways))
     application.add_handler(CommandHandler("donate", start_without_shipping_callback))
     application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-    application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
+    application.add_handler(
+        MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback)
+    )
+
+    # Several instances: every update sees and leaves the shared state
+    if shared_state:
+        application.add_handler(TypeHandler(Update, load_shared_state), group=-1)
+        application.add_handler(TypeHandler(Update, store_shared_state), group=1)
+    elif persistence is not None and persistence.lazy:
+        application.add_handler(TypeHandler(Update, restore_state), group=-1)
 
     # Generic error handler
     application.add_error_handler(error_handler)
 
+    # Background jobs
+    application.job_queue.run_repeating(
+        flush_usage, interval=usage_flush_interval, first=usage_flush_interval
+    )
+    application.job_queue.run_repeating(
+        cleanup_expired, interval=cleanup_interval, first=cleanup_interval
+    )
+    if metrics_log_interval:
+        application.job_queue.run_repeating(
+            log_metrics, interval=metrics_log_interval, first=metrics_log_interval
+        )
+
+    return application
+
+
+def main() -> None:
+    """Start the bot."""
+
+    if bot_token is None:
+        logger.error("Bot token not found in environment variable.")
+        return
+
+    if bot_mode == "webhook" and not webhook_url:
+        logger.error("WEBHOOK_URL is required with BOT_MODE=webhook.")
+        return
+
+    application = build_application(bot_token)
+
     # Run the bot until the user presses Ctrl-C
     logger.info("Bot initialized")
-    application.run_polling()
+    if bot_mode == "webhook":
+        application.run_webhook(
+            listen=webhook_listen,
+            port=webhook_port,
+            url_path=webhook_path,
+            webhook_url=f"{webhook_url.rstrip('/')}/{webhook_path}",
+            secret_token=webhook_secret,
+        )
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
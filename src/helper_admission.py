@@ -0,0 +1,165 @@
+import asyncio
+import logging
+
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from helper_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """The queue is full (globally or for this user), the job must be retried later."""
+
+
+class Ticket:
+    """A place in the admission queue, used as `async with ticket:` around the job.
+
+    Entering waits for the turn of the ticket, leaving frees the slot.
+    """
+
+    def __init__(self, controller: "AdmissionController", user_id):
+        self.controller = controller
+        self.user_id = user_id
+        self.granted = asyncio.get_running_loop().create_future()
+
+    @property
+    def position(self) -> int:
+        """1-based place in the queue, 0 once the job may run."""
+        return self.controller.position(self)
+
+    async def __aenter__(self) -> "Ticket":
+        try:
+            await self.granted
+        except asyncio.CancelledError:
+            self.controller.withdraw(self)
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        self.controller.release()
+
+
+class AdmissionController:
+    """Bounded, per-user fair admission of the detection and render jobs.
+
+    At most `max_active` jobs run at once. The others wait in one FIFO per
+    user, served round-robin, so a user sending many photos only delays
+    their own jobs. Once `max_queued` jobs wait in total, or
+    `max_user_queued` for one user, new jobs are rejected.
+    """
+
+    def __init__(self, max_active: int, max_queued: int, max_user_queued: int):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.max_user_queued = max_user_queued
+        self.active = 0
+        self.rejected = 0
+        self._queues = OrderedDict()
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def enter(self, user_id) -> Ticket:
+        """Ticket of a new job, already granted when a slot is free.
+
+        Raises AdmissionRejected when the job cannot even be queued.
+        """
+        ticket = Ticket(self, user_id)
+        if self.active < self.max_active and not self._queues:
+            self.active += 1
+            ticket.granted.set_result(True)
+            return ticket
+
+        queue = self._queues.get(user_id)
+        if self.queued >= self.max_queued or (
+            queue is not None and len(queue) >= self.max_user_queued
+        ):
+            self.rejected += 1
+            metrics.increment("admission_rejected")
+            raise AdmissionRejected(f"queue full for {user_id}")
+
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+        queue.append(ticket)
+        return ticket
+
+    def release(self) -> None:
+        self.active -= 1
+        self._dispatch()
+
+    def withdraw(self, ticket: Ticket) -> None:
+        """Remove a cancelled ticket, or give back its slot if it was granted."""
+        queue = self._queues.get(ticket.user_id)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.user_id]
+        elif ticket.granted.done() and not ticket.granted.cancelled():
+            self.release()
+
+    def _dispatch(self) -> None:
+        while self.active < self.max_active and self._queues:
+            user_id, queue = next(iter(self._queues.items()))
+            ticket = queue.popleft()
+            if queue:
+                # Next turn goes to the next user
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            if ticket.granted.done():
+                continue
+            self.active += 1
+            ticket.granted.set_result(True)
+
+    def position(self, ticket: Ticket) -> int:
+        """Place of a ticket in the round-robin order, 0 once granted."""
+        queue = self._queues.get(ticket.user_id)
+        if queue is None or ticket not in queue:
+            return 0
+
+        depth = queue.index(ticket)
+        position = 0
+        before = True
+        for user_id, other in self._queues.items():
+            if user_id == ticket.user_id:
+                position += depth + 1
+                before = False
+            else:
+                # Users before this one in the rotation get one more turn
+                position += min(len(other), depth + 1 if before else depth)
+        return position
+
+
+class KeyedLock:
+    """One asyncio.Lock per key (a user), dropped once nobody holds or awaits it.
+
+    Waiters are served in arrival order.
+    """
+
+    def __init__(self):
+        self._locks = {}
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def pending(self, key) -> int:
+        """Holders and waiters of a key."""
+        entry = self._locks.get(key)
+        return entry[1] if entry else 0
+
+    def __len__(self) -> int:
+        return len(self._locks)
@@ -1,18 +1,192 @@
-import boto3
+import os
+import json
+import asyncio
+import logging
 
-# Cacheable references
-rekognition = boto3.client("rekognition")
+from botocore.config import Config
+from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+
+from helper_cache import DetectionCache, content_key, unique_id_key
+from helper_detectors import create_detector
+from helper_faces import FaceBox, faces_from_response
+from helper_metrics import metrics
+from helper_rekognition import create_rekognition_pool, parse_endpoints
+from helper_resilience import aws_retryable, stage_from_env
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables from .env file
+load_dotenv()
 
+# Detector backend of this deployment: rekognition, local, cascade or replay.
+# The local and replay backends run without AWS credentials.
+face_detector = os.getenv("FACE_DETECTOR", "rekognition")
 
-# Function to call Amazon Rekognition and detect faces in an image
-async def detect_faces(image_path):
-    """Count the number of faces in one app"""
+# Deadline, retries and optional hedging (DETECTION_HEDGE_PERCENTILE) of
+# each detection, with a circuit breaker named after the detector
+detection_stage = stage_from_env(
+    "detection",
+    face_detector,
+    timeout=15,
+    attempts=2,
+    retryable=aws_retryable,
+    hedge=True,
+)
 
-    with open(image_path, "rb") as image_file:
-        image_bytes = image_file.read()
+# Detection concurrency: how many Rekognition calls may be in flight at once.
+# Threads and connections get twice that, room for the hedged requests and
+# for the calls abandoned at their deadline, still waiting for botocore.
+max_concurrency = int(os.getenv("REKOGNITION_MAX_CONCURRENCY", "32"))
+connect_timeout = float(os.getenv("REKOGNITION_CONNECT_TIMEOUT", "5"))
+# A call outliving the detection deadline only holds a thread: botocore
+# gives up before it, and leaves the retries to the detection stage. The
+# single attempt also lets the client pool fail a throttled call over at once.
+read_timeout = min(
+    float(os.getenv("REKOGNITION_READ_TIMEOUT", "10")), detection_stage.timeout
+)
 
-    response = rekognition.detect_faces(
-        Image={"Bytes": image_bytes}, Attributes=["ALL"]
+rekognition_config = Config(
+    max_pool_connections=2 * max_concurrency,
+    connect_timeout=connect_timeout,
+    read_timeout=read_timeout,
+    tcp_keepalive=True,
+    retries={"total_max_attempts": 1, "mode": "standard"},
+)
+
+# Rekognition clients: one per REKOGNITION_ENDPOINTS entry (region, account
+# profile or endpoint URL), default region and credentials when unset.
+rekognition_endpoints = parse_endpoints(os.getenv("REKOGNITION_ENDPOINTS", ""))
+rekognition_pool_strategy = os.getenv("REKOGNITION_POOL_STRATEGY", "least_in_flight")
+rekognition_backoff_base = float(os.getenv("REKOGNITION_BACKOFF_BASE", "1"))
+rekognition_backoff_max = float(os.getenv("REKOGNITION_BACKOFF_MAX", "60"))
+
+# Cacheable references
+rekognition = None
+if face_detector in ("rekognition", "cascade"):
+    rekognition = create_rekognition_pool(
+        rekognition_endpoints,
+        rekognition_config,
+        strategy=rekognition_pool_strategy,
+        backoff_base=rekognition_backoff_base,
+        backoff_max=rekognition_backoff_max,
     )
+detection_executor = ThreadPoolExecutor(
+    max_workers=2 * max_concurrency, thread_name_prefix="rekognition"
+)
+_detection_slots = None
+_detections_waiting = 0
+_detections_in_flight = 0
+
+metrics.gauge(
+    "detections_waiting",
+    "Detections waiting for a free slot.",
+    lambda: _detections_waiting,
+)
+metrics.gauge(
+    "detections_in_flight", "Detections being processed.", lambda: _detections_in_flight
+)
+
+# Only BoundingBox and Confidence are used. "ALL" attributes (and a JSON dump
+# of the raw response next to the photo) are a debug opt-in.
+full_attributes = os.getenv("REKOGNITION_FULL_ATTRIBUTES", "0") == "1"
+detection_attributes = ["ALL"] if full_attributes else ["DEFAULT"]
+
+# Selected face detector
+detector = create_detector(face_detector, rekognition, detection_attributes)
+
+# Detection cache: forwarded and re-sent photos skip Rekognition entirely.
+cache_folder = os.getenv("DETECTION_CACHE_FOLDER") or None
+detection_cache = DetectionCache(
+    max_entries=int(os.getenv("DETECTION_CACHE_ENTRIES", "1024")),
+    ttl=float(os.getenv("DETECTION_CACHE_TTL", "86400")),
+    folder=cache_folder,
+    disk_budget=int(os.getenv("DETECTION_CACHE_DISK_BUDGET", str(64 * 1024 * 1024))),
+)
+
+
+def _get_detection_slots() -> asyncio.Semaphore:
+    """Lazily create the semaphore so it binds to the running event loop."""
+    global _detection_slots
+    if _detection_slots is None:
+        _detection_slots = asyncio.Semaphore(max_concurrency)
+    return _detection_slots
+
+
+def _detect_faces_sync(image_source, file_unique_id=None):
+    """Blocking part of the detection: cache lookups, file read and the detector.
+
+    `image_source` is either a file path or the image bytes already in memory.
+    Returns the face records as plain tuples, which is also what gets cached.
+    """
+
+    uid_key = unique_id_key(file_unique_id) if file_unique_id else None
+    if uid_key:
+        records = detection_cache.get(uid_key, count_miss=False)
+        if records is not None:
+            return records
+
+    if isinstance(image_source, (bytes, bytearray, memoryview)):
+        image_bytes = bytes(image_source)
+    else:
+        with open(image_source, "rb") as image_file:
+            image_bytes = image_file.read()
+
+    hash_key = content_key(image_bytes)
+    records = detection_cache.get(hash_key)
+    if records is not None:
+        detection_cache.put([uid_key], records)
+        return records
+
+    response = detector.detect(image_bytes)
+    records = [face.to_record() for face in faces_from_response(response)]
+    detection_cache.put([uid_key, hash_key], records)
+
+    if full_attributes and isinstance(image_source, str):
+        with open(f"{image_source}.json", "w") as json_file:
+            json.dump(response, json_file, indent=4)
+
+    return records
+
+
+# Function to detect the faces of an image with the configured detector
+async def detect_faces(image_source, file_unique_id=None):
+    """Detect the faces of a photo, as a list of compact FaceBox records.
+
+    Detections are cached by Telegram's file_unique_id and by content hash. A
+    memory hit on the file_unique_id answers straight from the event loop;
+    everything else (disk tier, file read and the detector) runs on a
+    dedicated thread pool, so the event loop keeps serving other chats.
+    Raises DependencyUnavailable when the detector misses its deadline.
+    """
+
+    global _detections_waiting, _detections_in_flight
+
+    records = None
+    if file_unique_id:
+        records = detection_cache.peek(unique_id_key(file_unique_id))
+
+    if records is None:
+        loop = asyncio.get_running_loop()
+        _detections_waiting += 1
+        waiting = True
+        try:
+            async with _get_detection_slots():
+                _detections_waiting -= 1
+                waiting = False
+                _detections_in_flight += 1
+                try:
+                    records = await detection_stage.call(
+                        loop.run_in_executor,
+                        detection_executor,
+                        _detect_faces_sync,
+                        image_source,
+                        file_unique_id,
+                    )
+                finally:
+                    _detections_in_flight -= 1
+        finally:
+            if waiting:
+                _detections_waiting -= 1
 
-    return response
+    return [FaceBox.from_record(record) for record in records]
@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def content_key(image_bytes: bytes) -> str:
+    """Cache key derived from the image content itself."""
+    return "sha256-" + hashlib.sha256(image_bytes).hexdigest()
+
+
+def unique_id_key(file_unique_id: str) -> str:
+    """Cache key derived from Telegram's file_unique_id (stable across chats)."""
+    return f"uid-{file_unique_id}"
+
+
+class DetectionCache:
+    """Two tier cache for face detection results (JSON-serializable values).
+
+    The memory tier is an LRU bounded by number of entries, the optional disk
+    tier keeps one JSON file per key, up to `disk_budget` bytes once pruned
+    (see `prune`). Both tiers expire entries after `ttl` seconds. It is safe
+    to use from the detection thread pool.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float = 86400,
+        folder: str = None,
+        disk_budget: int = 0,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.folder = folder
+        self.disk_budget = disk_budget
+        self.hits = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        if self.folder and not os.path.exists(self.folder):
+            os.makedirs(self.folder, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.folder, f"faces-{key}.json")
+
+    def _get_memory(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        stored_at, value = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def _put_memory(self, key: str, value) -> None:
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _get_disk(self, key: str):
+        if not self.folder:
+            return None
+
+        disk_path = self._disk_path(key)
+        try:
+            if time.time() - os.path.getmtime(disk_path) > self.ttl:
+                os.remove(disk_path)
+                return None
+            with open(disk_path, "r") as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError):
+            return None
+
+    def _put_disk(self, key: str, value) -> None:
+        if not self.folder:
+            return
+
+        disk_path = self._disk_path(key)
+        tmp_path = f"{disk_path}.tmp"
+        try:
+            with open(tmp_path, "w") as json_file:
+                json.dump(value, json_file)
+            os.replace(tmp_path, disk_path)
+        except (OSError, TypeError) as e:
+            logger.warning(f"Unable to persist detection cache entry {key}: {str(e)}")
+
+    def peek(self, key: str):
+        """Memory-only lookup, cheap enough to run on the event loop."""
+        with self._lock:
+            value = self._get_memory(key)
+            if value is not None:
+                self.hits += 1
+                self.memory_hits += 1
+        return value
+
+    def get(self, key: str, count_miss: bool = True):
+        """Look a key up in memory and then on disk, promoting disk hits."""
+        with self._lock:
+            value = self._get_memory(key)
+            if value is not None:
+                self.hits += 1
+                self.memory_hits += 1
+                return value
+
+        value = self._get_disk(key)
+        with self._lock:
+            if value is not None:
+                self._put_memory(key, value)
+                self.hits += 1
+                self.disk_hits += 1
+            elif count_miss:
+                self.misses += 1
+        return value
+
+    def put(self, keys, value) -> None:
+        """Store the same value under every given key."""
+        keys = [key for key in keys if key]
+        with self._lock:
+            for key in keys:
+                self._put_memory(key, value)
+        for key in keys:
+            self._put_disk(key, value)
+
+    def prune(self) -> int:
+        """Delete the expired disk entries, then the oldest ones over `disk_budget`.
+
+        Returns the number of files deleted. Blocking, run it off the event
+        loop.
+        """
+        if not self.folder:
+            return 0
+
+        now = time.time()
+        entries = []
+        deleted = 0
+        try:
+            with os.scandir(self.folder) as scan:
+                for entry in scan:
+                    if not entry.name.startswith("faces-"):
+                        continue
+                    try:
+                        stat = entry.stat()
+                        if now - stat.st_mtime > self.ttl:
+                            os.remove(entry.path)
+                            deleted += 1
+                        else:
+                            entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    except OSError:
+                        continue
+        except OSError as e:
+            logger.warning(f"Unable to prune detection cache: {str(e)}")
+            return deleted
+
+        if self.disk_budget > 0:
+            size = sum(entry[1] for entry in entries)
+            entries.sort()
+            for _, file_size, path in entries:
+                if size <= self.disk_budget:
+                    break
+                try:
+                    os.remove(path)
+                    deleted += 1
+                except OSError:
+                    pass
+                size -= file_size
+        return deleted
+
+    def clear(self) -> None:
+        """Drop the memory tier, the disk tier is left to expire."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class SentFileCache:
+    """Telegram file_id of renders already sent, by (source file_id, render spec).
+
+    Telegram keeps every file it received: sending the file_id again skips
+    both the render and the upload. An LRU bounded by number of entries,
+    expiring entries after `ttl` seconds. Used from the event loop only.
+    """
+
+    def __init__(self, max_entries: int = 4096, ttl: float = 604800):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        stored_at, file_id = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return file_id
+
+    def put(self, key, file_id: str) -> None:
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (time.monotonic(), file_id)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, key) -> None:
+        """Forget a file_id Telegram refused."""
+        self._entries.pop(key, None)
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._entries)
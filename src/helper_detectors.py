@@ -0,0 +1,244 @@
+import io
+import os
+import glob
+import json
+import time
+import logging
+import threading
+
+from PIL import Image, ImageOps
+
+from helper_cache import content_key
+from helper_images import prepare_for_detection
+from helper_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# Face detectors. Every backend answers `detect(image_bytes)` with a dict in
+# the DetectFaces response shape ({"FaceDetails": [{"BoundingBox": ...,
+# "Confidence": ...}]}), with boxes normalized to the image size, so the
+# cache, the FaceBox records and the renderers do not care which one ran.
+# `detect` is blocking and runs on the detection thread pool.
+
+
+class RekognitionDetector:
+    """Amazon Rekognition DetectFaces on a downscaled copy of the photo."""
+
+    name = "rekognition"
+
+    def __init__(self, client, attributes: list):
+        self.client = client
+        self.attributes = attributes
+
+    def detect(self, image_bytes: bytes) -> dict:
+        start_time = time.perf_counter()
+        payload = prepare_for_detection(image_bytes)
+        prepare_time = time.perf_counter()
+        response = self.client.detect_faces(
+            Image={"Bytes": payload}, Attributes=self.attributes
+        )
+        end_time = time.perf_counter()
+        metrics.observe("rekognition", end_time - prepare_time)
+        logger.info(
+            f"Detection payload {len(image_bytes)} -> {len(payload)} bytes, "
+            f"prepare {(prepare_time - start_time) * 1000:.1f} ms, "
+            f"rekognition {(end_time - prepare_time) * 1000:.1f} ms"
+        )
+        return response
+
+
+class LocalDetector:
+    """OpenCV Haar cascade on the CPU: no network call and no per-image cost.
+
+    Haar cascades do not return a score, so the confidence is derived from
+    the cascade level weights (the margin of the last stage). It is only a
+    relative measure, used by the cascade mode to decide when to ask
+    Rekognition. OpenCV is optional (`pip install opencv-python-headless`).
+    """
+
+    name = "local"
+
+    def __init__(
+        self, max_edge: int = 1024, min_face: int = 24, cascade_path: str = None
+    ):
+        try:
+            import cv2
+            import numpy
+        except ImportError as e:
+            raise RuntimeError(
+                "FACE_DETECTOR=local needs OpenCV: pip install opencv-python-headless"
+            ) from e
+
+        self._cv2 = cv2
+        self._numpy = numpy
+        self.max_edge = max_edge
+        self.min_face = min_face
+        cascade_path = cascade_path or os.path.join(
+            cv2.data.haarcascades, "haarcascade_frontalface_default.xml"
+        )
+        self.cascade_path = cascade_path
+        self._local = threading.local()
+        self._get_cascade()
+
+    def _get_cascade(self):
+        # CascadeClassifier is not thread safe: one per detection thread
+        cascade = getattr(self._local, "cascade", None)
+        if cascade is None:
+            cascade = self._cv2.CascadeClassifier(self.cascade_path)
+            if cascade.empty():
+                raise RuntimeError(f"Cannot load the face cascade {self.cascade_path}")
+            self._local.cascade = cascade
+        return cascade
+
+    def _gray(self, image_bytes: bytes):
+        image = Image.open(io.BytesIO(image_bytes))
+        # Let the JPEG decoder skip what the downscale would throw away
+        image.draft("L", (self.max_edge, self.max_edge))
+        image = ImageOps.exif_transpose(image).convert("L")
+        image.thumbnail((self.max_edge, self.max_edge), Image.BILINEAR)
+        return self._numpy.asarray(image)
+
+    def detect(self, image_bytes: bytes) -> dict:
+        with metrics.span("local_detection"):
+            gray = self._cv2.equalizeHist(self._gray(image_bytes))
+            boxes, _, weights = self._get_cascade().detectMultiScale3(
+                gray,
+                scaleFactor=1.1,
+                minNeighbors=5,
+                minSize=(self.min_face, self.min_face),
+                outputRejectLevels=True,
+            )
+
+        height, width = gray.shape
+        details = []
+        for (left, top, box_width, box_height), weight in zip(boxes, weights):
+            details.append(
+                {
+                    "BoundingBox": {
+                        "Width": float(box_width) / width,
+                        "Height": float(box_height) / height,
+                        "Left": float(left) / width,
+                        "Top": float(top) / height,
+                    },
+                    # Margin above the last stage threshold, mapped onto 50-100
+                    "Confidence": max(0.0, min(100.0, 50.0 + 10.0 * float(weight))),
+                }
+            )
+        return {"FaceDetails": details}
+
+
+def _signature(image: Image.Image) -> list:
+    """Tiny grayscale thumbnail, survives a downscale or a re-encode."""
+    return list(image.convert("L").resize((8, 8)).getdata())
+
+
+class ReplayDetector:
+    """Serves recorded DetectFaces responses, e.g. the samples/*.jpg.json files.
+
+    A photo is matched by content hash with the image next to each JSON file,
+    or, when nothing matches exactly, with the closest looking one. Meant for
+    demos, benchmarks and load tests without AWS credentials.
+    """
+
+    name = "replay"
+
+    def __init__(self, folder: str, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+        self._by_hash = {}
+        self._samples = []
+        for json_path in sorted(glob.glob(os.path.join(folder, "*.json"))):
+            image_path = json_path[: -len(".json")]
+            if not os.path.exists(image_path):
+                continue
+            with open(json_path) as json_file:
+                response = json.load(json_file)
+            with open(image_path, "rb") as image_file:
+                image_bytes = image_file.read()
+            self._by_hash[content_key(image_bytes)] = response
+            self._samples.append(
+                (_signature(Image.open(io.BytesIO(image_bytes))), response)
+            )
+
+        if not self._samples:
+            raise RuntimeError(f"No recorded responses found in {folder}")
+        logger.info(
+            f"Replay detector loaded {len(self._samples)} response(s) from {folder}"
+        )
+
+    def detect(self, image_bytes: bytes) -> dict:
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        response = self._by_hash.get(content_key(image_bytes))
+        if response is not None:
+            return response
+
+        signature = _signature(Image.open(io.BytesIO(image_bytes)))
+        _, response = min(
+            self._samples,
+            key=lambda sample: sum(abs(a - b) for a, b in zip(sample[0], signature)),
+        )
+        return response
+
+
+class CascadeDetector:
+    """Local detector first, Rekognition only when the local answer is doubtful.
+
+    The local result is kept when it found at least one face and every face
+    is at least `min_confidence`. No face at all also goes to Rekognition:
+    for a privacy tool a missed face is worse than a paid call.
+    """
+
+    name = "cascade"
+
+    def __init__(self, local, remote, min_confidence: float):
+        self.local = local
+        self.remote = remote
+        self.min_confidence = min_confidence
+
+    def detect(self, image_bytes: bytes) -> dict:
+        response = self.local.detect(image_bytes)
+        confidences = [face["Confidence"] for face in response["FaceDetails"]]
+        if confidences and min(confidences) >= self.min_confidence:
+            metrics.increment("cascade_local_answers")
+            return response
+
+        metrics.increment("cascade_fallbacks")
+        logger.info(
+            f"Local detection not confident enough ({len(confidences)} face(s), "
+            f"min {min(confidences, default=0):.1f}), asking {self.remote.name}"
+        )
+        return self.remote.detect(image_bytes)
+
+
+def create_detector(backend: str, rekognition, attributes: list):
+    """The face detector selected for this deployment (FACE_DETECTOR)."""
+    if backend == "rekognition":
+        return RekognitionDetector(rekognition, attributes)
+
+    if backend in ("local", "cascade"):
+        local = LocalDetector(
+            max_edge=int(os.getenv("LOCAL_DETECTOR_MAX_EDGE", "1024")),
+            min_face=int(os.getenv("LOCAL_DETECTOR_MIN_FACE", "24")),
+            cascade_path=os.getenv("LOCAL_DETECTOR_CASCADE") or None,
+        )
+        if backend == "local":
+            return local
+        return CascadeDetector(
+            local,
+            RekognitionDetector(rekognition, attributes),
+            min_confidence=float(os.getenv("CASCADE_MIN_CONFIDENCE", "80")),
+        )
+
+    if backend == "replay":
+        return ReplayDetector(
+            os.getenv("REPLAY_DETECTOR_FOLDER", "samples"),
+            latency=float(os.getenv("REPLAY_DETECTOR_LATENCY", "0")),
+        )
+
+    raise ValueError(
+        f"Unknown FACE_DETECTOR {backend!r}, expected rekognition, local, cascade or replay"
+    )
@@ -0,0 +1,185 @@
+import os
+import asyncio
+import logging
+import threading
+import boto3
+import botocore
+
+from botocore.config import Config
+from dotenv import load_dotenv
+
+from helper_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Bounded DynamoDB calls: a stuck write fails in seconds instead of minutes
+dynamodb_config = Config(
+    connect_timeout=float(os.getenv("DYNAMODB_CONNECT_TIMEOUT", "3")),
+    read_timeout=float(os.getenv("DYNAMODB_READ_TIMEOUT", "5")),
+    retries={"max_attempts": 3, "mode": "standard"},
+)
+
+
+class InMemoryTable:
+    """Local stand-in for the users table, with the calls the bot makes.
+
+    Select it with USAGE_TABLE_BACKEND=memory for tests and offline runs.
+    """
+
+    def __init__(self):
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def put_item(self, Item, ConditionExpression=None):
+        with self._lock:
+            if (
+                ConditionExpression == "attribute_not_exists(user_id)"
+                and Item["user_id"] in self.items
+            ):
+                raise botocore.exceptions.ClientError(
+                    {
+                        "Error": {
+                            "Code": "ConditionalCheckFailedException",
+                            "Message": "exists",
+                        }
+                    },
+                    "PutItem",
+                )
+            self.items[Item["user_id"]] = dict(Item)
+
+    def update_item(
+        self, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues
+    ):
+        # Only the counter increment used by the bot is understood
+        attribute = ExpressionAttributeNames["#count"]
+        with self._lock:
+            item = self.items.setdefault(
+                Key["user_id"], {"user_id": Key["user_id"], attribute: 0}
+            )
+            item[attribute] = (
+                item.get(attribute, 0) + ExpressionAttributeValues[":increment"]
+            )
+
+
+def create_table(table_name: str):
+    """The users table: DynamoDB (or DynamoDB Local) or the in-memory fake."""
+    if os.getenv("USAGE_TABLE_BACKEND", "dynamodb") == "memory":
+        return InMemoryTable()
+
+    endpoint_url = os.getenv("DYNAMODB_ENDPOINT_URL") or None
+    return boto3.resource(
+        "dynamodb", endpoint_url=endpoint_url, config=dynamodb_config
+    ).Table(table_name)
+
+
+class UsageRecorder:
+    """Write-behind aggregator for registrations and photo counters.
+
+    Handlers only touch memory: increments are coalesced per user_id and
+    registrations deduplicated until `flush` writes them, which happens
+    periodically, when `max_pending` users are waiting, and on shutdown.
+
+    With a circuit `breaker`, flushes are skipped while DynamoDB is down and
+    the writes stay buffered. A flush has no deadline of its own (a write
+    abandoned mid-flight could be counted twice): dynamodb_config bounds
+    every call instead.
+    """
+
+    def __init__(self, table, max_pending: int = 100, breaker=None):
+        self.table = table
+        self.max_pending = max_pending
+        self.breaker = breaker
+        self._registrations = {}
+        self._increments = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._registrations) + len(self._increments)
+
+    def register(self, item: dict) -> None:
+        self._registrations.setdefault(item["user_id"], item)
+        self._maybe_flush()
+
+    def increment(self, user_id: str, amount: int = 1) -> None:
+        self._increments[user_id] = self._increments.get(user_id, 0) + amount
+        self._maybe_flush()
+
+    def _maybe_flush(self) -> None:
+        if self.pending >= self.max_pending and (
+            self._flush_task is None or self._flush_task.done()
+        ):
+            self._flush_task = asyncio.ensure_future(self.flush())
+
+    def _write(self, registrations: dict, increments: dict) -> tuple:
+        """Blocking writes, returns what could not be written."""
+        failed_registrations = {}
+        failed_increments = {}
+
+        # Registrations first, so the counters always have an item to update
+        for user_id, item in registrations.items():
+            try:
+                self.table.put_item(
+                    Item=item, ConditionExpression="attribute_not_exists(user_id)"
+                )
+            except botocore.exceptions.ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    logger.error(f"Registration of {user_id} failed: {str(e)}")
+                    failed_registrations[user_id] = item
+            except botocore.exceptions.BotoCoreError as e:
+                logger.error(f"Registration of {user_id} failed: {str(e)}")
+                failed_registrations[user_id] = item
+
+        for user_id, amount in increments.items():
+            try:
+                self.table.update_item(
+                    Key={"user_id": user_id},
+                    UpdateExpression="SET #count = #count + :increment",
+                    ExpressionAttributeNames={"#count": "count"},
+                    ExpressionAttributeValues={":increment": amount},
+                )
+            except (
+                botocore.exceptions.ClientError,
+                botocore.exceptions.BotoCoreError,
+            ) as e:
+                logger.error(f"Counter update of {user_id} failed: {str(e)}")
+                failed_increments[user_id] = amount
+
+        return failed_registrations, failed_increments
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self.pending:
+                return
+            if self.breaker is not None and not self.breaker.allow():
+                logger.info(
+                    f"DynamoDB unavailable, keeping {self.pending} pending write(s)"
+                )
+                return
+
+            registrations, self._registrations = self._registrations, {}
+            increments, self._increments = self._increments, {}
+            logger.info(
+                f"Flushing {len(registrations)} registration(s) and {len(increments)} counter(s)"
+            )
+
+            with metrics.span("dynamodb_flush"):
+                failed_registrations, failed_increments = await asyncio.to_thread(
+                    self._write, registrations, increments
+                )
+
+            if self.breaker is not None:
+                if failed_registrations or failed_increments:
+                    self.breaker.failure()
+                else:
+                    self.breaker.success()
+
+            # Keep what failed for the next flush
+            for user_id, item in failed_registrations.items():
+                self._registrations.setdefault(user_id, item)
+            for user_id, amount in failed_increments.items():
+                self._increments[user_id] = self._increments.get(user_id, 0) + amount
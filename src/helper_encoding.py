@@ -0,0 +1,128 @@
+import io
+import os
+import logging
+
+from dotenv import load_dotenv
+from PIL import Image
+
+from helper_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables from .env file
+load_dotenv()
+
+format_extensions = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+lossy_formats = ("JPEG", "WEBP")
+
+# Settings chosen by image size: progressive JPEG pays off from a few hundred
+# kilopixels on, the extra optimize pass is skipped on the largest images.
+progressive_min_pixels = int(os.getenv("ENCODE_PROGRESSIVE_MIN_PIXELS", str(512 * 512)))
+optimize_max_pixels = int(
+    os.getenv("ENCODE_OPTIMIZE_MAX_PIXELS", str(16 * 1000 * 1000))
+)
+
+
+class EncodingSpec:
+    """How one kind of render is encoded.
+
+    `image_format` is a Pillow format name, or "source" to keep the format
+    of the photo. Lossy formats use `quality`; with `target_bytes`, a result
+    too big is encoded again at the highest quality (not below
+    `min_quality`) that fits.
+    """
+
+    __slots__ = ("image_format", "quality", "min_quality", "target_bytes")
+
+    def __init__(
+        self,
+        image_format: str = "source",
+        quality: int = 85,
+        min_quality: int = 50,
+        target_bytes: int = 0,
+    ):
+        image_format = image_format.upper()
+        if image_format != "SOURCE" and image_format not in format_extensions:
+            raise ValueError(
+                f"Unknown output format {image_format!r}, expected source, {', '.join(format_extensions)}"
+            )
+        self.image_format = "source" if image_format == "SOURCE" else image_format
+        self.quality = quality
+        self.min_quality = min(min_quality, quality)
+        self.target_bytes = target_bytes
+
+    def key(self) -> tuple:
+        """Everything deciding the encoded bytes, for caching."""
+        return (
+            self.image_format,
+            self.quality,
+            self.min_quality,
+            self.target_bytes,
+            progressive_min_pixels,
+            optimize_max_pixels,
+        )
+
+    def resolve_format(self, source_format: str) -> str:
+        if self.image_format == "source":
+            return source_format if source_format in format_extensions else "JPEG"
+        return self.image_format
+
+    def extension(self, source_extension: str) -> str:
+        """File extension of the output, from the extension of the photo."""
+        if self.image_format == "source":
+            return source_extension
+        return format_extensions[self.image_format]
+
+
+def _save(image: Image.Image, image_format: str, quality: int) -> bytes:
+    pixels = image.width * image.height
+    optimize = pixels <= optimize_max_pixels
+    if image_format == "JPEG":
+        options = {
+            "quality": quality,
+            "progressive": pixels >= progressive_min_pixels,
+            "optimize": optimize,
+        }
+    elif image_format == "WEBP":
+        options = {"quality": quality, "method": 4 if optimize else 0}
+    else:
+        options = {"optimize": optimize}
+
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+
+def encode_image(image: Image.Image, spec: EncodingSpec, source_format: str) -> bytes:
+    """Encode following `spec`; `source_format` is the Pillow format of the photo."""
+    image_format = spec.resolve_format(source_format)
+    if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    content = _save(image, image_format, spec.quality)
+    if (
+        not spec.target_bytes
+        or len(content) <= spec.target_bytes
+        or image_format not in lossy_formats
+    ):
+        return content
+
+    # Binary search of the highest quality within the target
+    metrics.increment("encode_quality_searches")
+    best = None
+    low, high = spec.min_quality, spec.quality - 1
+    while low <= high:
+        quality = (low + high) // 2
+        candidate = _save(image, image_format, quality)
+        if len(candidate) <= spec.target_bytes:
+            best, low = candidate, quality + 1
+        else:
+            high = quality - 1
+
+    if best is None:
+        # Nothing fits: the last try was the smallest, at min_quality
+        logger.warning(
+            f"{image.size} image above {spec.target_bytes} bytes even at quality {spec.min_quality}"
+        )
+        best = candidate if spec.min_quality < spec.quality else content
+    return best
@@ -0,0 +1,69 @@
+class FaceBox:
+    """Compact record of one detected face: its normalized box and confidence.
+
+    Only what the renderers need is kept from a Rekognition FaceDetail. Item
+    access with the BoundingBox keys ("Left", "Top", "Width", "Height") is
+    supported, so a FaceBox can be used wherever a BoundingBox dict was.
+    """
+
+    __slots__ = ("left", "top", "width", "height", "confidence")
+
+    _keys = {"Left": "left", "Top": "top", "Width": "width", "Height": "height"}
+
+    def __init__(
+        self,
+        left: float,
+        top: float,
+        width: float,
+        height: float,
+        confidence: float = 100.0,
+    ):
+        self.left = left
+        self.top = top
+        self.width = width
+        self.height = height
+        self.confidence = confidence
+
+    def __getitem__(self, key: str) -> float:
+        return getattr(self, self._keys[key])
+
+    def __repr__(self) -> str:
+        return (
+            f"FaceBox(left={self.left:.4f}, top={self.top:.4f}, "
+            f"width={self.width:.4f}, height={self.height:.4f}, confidence={self.confidence:.1f})"
+        )
+
+    @classmethod
+    def from_face_detail(cls, face_detail: dict) -> "FaceBox":
+        box = face_detail["BoundingBox"]
+        return cls(
+            box["Left"],
+            box["Top"],
+            box["Width"],
+            box["Height"],
+            face_detail.get("Confidence", 100.0),
+        )
+
+    @classmethod
+    def from_record(cls, record) -> "FaceBox":
+        return cls(*record)
+
+    def to_record(self) -> tuple:
+        """Plain tuple form, used for caching and JSON."""
+        return (self.left, self.top, self.width, self.height, self.confidence)
+
+    def to_bounding_box(self) -> dict:
+        return {
+            "Width": self.width,
+            "Height": self.height,
+            "Left": self.left,
+            "Top": self.top,
+        }
+
+
+def faces_from_response(api_response: dict) -> list:
+    """Compact records of every face of a DetectFaces response."""
+    return [
+        FaceBox.from_face_detail(face_detail)
+        for face_detail in api_response["FaceDetails"]
+    ]
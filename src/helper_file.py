@@ -1,5 +1,6 @@
 import os
 import time
+import heapq
 import shutil
 import logging
 
@@ -29,33 +30,69 @@ def get_file_extension(url: str) -> str:
     return extension
 
 
-def delete_old_subfolders(path):
-    current_time = time.time()
-    hour_ago = current_time - 3600  # 3600 seconds = 1 hour
+class ExpiryIndex:
+    """Min-heap of expiry times for the user folders under TMP_FOLDER.
 
-    for folder_name in os.listdir(path):
-        folder_path = os.path.join(path, folder_name)
+    The bot touches a folder every time it writes (or keeps in memory) a file
+    for that user, and cleanup only pops the entries that are due instead of
+    walking the whole tree. Touching again just records a newer time: the old
+    heap entry is dropped lazily when it reaches the top.
+    """
 
-        # Check if the path is a directory
-        if os.path.isdir(folder_path):
-            # Get the latest modified time of files within the folder
+    def __init__(self, max_age: float = 3600):
+        self.max_age = max_age
+        self._last_touch = {}
+        self._heap = []
+
+    def __len__(self) -> int:
+        return len(self._last_touch)
+
+    def touch(self, path: str, when: float = None) -> None:
+        when = time.time() if when is None else when
+        if path in self._last_touch and when <= self._last_touch[path]:
+            return
+        self._last_touch[path] = when
+        heapq.heappush(self._heap, (when + self.max_age, path))
+
+    def pop_due(self, now: float = None) -> list:
+        """Remove and return the paths not touched within max_age."""
+        now = time.time() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, path = heapq.heappop(self._heap)
+            last_touch = self._last_touch.get(path)
+            if last_touch is not None and last_touch + self.max_age == expires_at:
+                del self._last_touch[path]
+                due.append(path)
+        return due
+
+    def rebuild(self, root: str) -> None:
+        """One-time scan at startup, to expire what previous runs left behind."""
+        if not os.path.isdir(root):
+            return
+
+        for folder in os.scandir(root):
+            if not folder.is_dir():
+                continue
             latest_modified_time = max(
-                [
-                    os.path.getmtime(os.path.join(folder_path, file_name))
-                    for file_name in os.listdir(folder_path)
-                    if os.path.isfile(os.path.join(folder_path, file_name))
-                ],
+                (
+                    entry.stat().st_mtime
+                    for entry in os.scandir(folder.path)
+                    if entry.is_file()
+                ),
                 default=0,
             )
+            self.touch(folder.path, latest_modified_time)
+
+        logger.info(f"Expiry index rebuilt with {len(self)} folder(s) from {root}")
+
 
-            # Delete the subfolder if no new files were created within the last hour
-            if latest_modified_time <= hour_ago:
-                try:
-                    # Remove the subfolder and its contents recursively
-                    # os.rmdir(folder_path)
-                    shutil.rmtree(folder_path, ignore_errors=True)
-                    logger.info(f"Deleted folder: {folder_path}")
-                except OSError as e:
-                    logger.error(
-                        f"Error deleting folder: {folder_path}. Reason: {str(e)}"
-                    )
+def delete_folder(folder_path: str) -> None:
+    """Remove a user folder and its contents, if still there."""
+    if not os.path.isdir(folder_path):
+        return
+    try:
+        shutil.rmtree(folder_path)
+        logger.info(f"Deleted folder: {folder_path}")
+    except OSError as e:
+        logger.error(f"Error deleting folder: {folder_path}. Reason: {str(e)}")
@@ -1,7 +1,17 @@
+import io
 import os
+import bisect
+import asyncio
 import logging
+import numpy
+
+from functools import lru_cache
 from PIL import Image, ImageDraw, ImageFilter, ImageOps, ImageFont
 
+from helper_render import run_in_render_pool
+from helper_metrics import metrics
+from helper_encoding import EncodingSpec, encode_image
+
 TINT_COLOR = (255, 0, 0)  # RED
 TRANSPARENCY = 0.35  # Degree of transparency, 0-100%
 OPACITY = int(255 * TRANSPARENCY)
@@ -11,96 +21,429 @@ border_fill = "black"
 reference_color = "red"
 font_color = (255, 255, 255)
 
+blur_radius = 20
+blur_padding = 3 * blur_radius  # Gaussian tail, keeps crop edges out of the ellipse
+
+# Anonymization modes, cheapest last: blur (Gaussian, the original look),
+# pixelate (mosaic of `pixelate_blocks` cells across the face), fill (solid
+# ellipse) and box (solid rectangle). ANONYMIZE_MODE is the server default.
+anonymize_modes = ("blur", "pixelate", "fill", "box")
+default_anonymize_mode = os.getenv("ANONYMIZE_MODE", "blur")
+pixelate_blocks = int(os.getenv("PIXELATE_BLOCKS", "10"))
+fill_color = (0, 0, 0)
+if default_anonymize_mode not in anonymize_modes:
+    raise ValueError(
+        f"Unknown ANONYMIZE_MODE {default_anonymize_mode!r}, expected one of {anonymize_modes}"
+    )
+
 script_dir = os.path.dirname(__file__)
 rel_path = "../assets/DejaVuSans.ttf"
 font_file = os.path.join(script_dir, rel_path)
 
+# Detection payload: Rekognition boxes are normalized, so a smaller copy is
+# enough to find the faces while rendering keeps using the original.
+detection_max_edge = int(os.getenv("DETECTION_MAX_EDGE", "1920"))
+detection_jpeg_quality = int(os.getenv("DETECTION_JPEG_QUALITY", "85"))
+
+# Reference preview: decoded straight at this size (JPEG draft mode) and
+# sent as a small progressive JPEG. 0 keeps the full resolution.
+reference_max_edge = int(os.getenv("REFERENCE_MAX_EDGE", "1280"))
+reference_jpeg_quality = int(os.getenv("REFERENCE_JPEG_QUALITY", "80"))
+reference_encoding = EncodingSpec(
+    os.getenv("REFERENCE_FORMAT", "JPEG" if reference_max_edge else "source"),
+    quality=reference_jpeg_quality,
+    target_bytes=int(os.getenv("REFERENCE_TARGET_BYTES", "0")),
+)
+
+# Anonymized photos: OUTPUT_FORMAT is source (keep the format of the photo),
+# JPEG, PNG or WEBP. Lossy results above OUTPUT_TARGET_BYTES (Telegram takes
+# photos up to 10 MB) are encoded again at a lower quality, down to
+# OUTPUT_MIN_QUALITY. 0 disables the target.
+output_encoding = EncodingSpec(
+    os.getenv("OUTPUT_FORMAT", "source"),
+    quality=int(os.getenv("OUTPUT_QUALITY", "85")),
+    min_quality=int(os.getenv("OUTPUT_MIN_QUALITY", "60")),
+    target_bytes=int(os.getenv("OUTPUT_TARGET_BYTES", str(10 * 1024 * 1024))),
+)
+
+# Label sizes are snapped to these buckets so the font cache stays small
+font_size_buckets = (10, 14, 20, 28, 40, 56, 80, 112, 160, 224, 320)
+
 logger = logging.getLogger(__name__)
 
 
-async def generate_reference(
-    image_path: str,
-    output_path: str,
-    original_filename: str,
-    original_extension: str,
-    api_response: dict,
-) -> str:
-    counter = 1
-    faces = {}
+def quantize_font_size(size: float) -> int:
+    """Snap a font size to the closest bucket at or above it."""
+    index = bisect.bisect_left(font_size_buckets, size)
+    return font_size_buckets[min(index, len(font_size_buckets) - 1)]
+
+
+@lru_cache(maxsize=None)
+def get_font(size: int) -> ImageFont.FreeTypeFont:
+    """Process-wide cache of the label font, call it with a quantized size."""
+    return ImageFont.truetype(font_file, size)
+
+
+def _pixel_box(box: dict, imgWidth: int, imgHeight: int) -> tuple:
+    """Convert a normalized Rekognition BoundingBox to pixel coordinates."""
+    left = imgWidth * box["Left"]
+    top = imgHeight * box["Top"]
+    width = imgWidth * box["Width"]
+    height = imgHeight * box["Height"]
+    return left, top, left + width, top + height
+
+
+def _open_image(source, max_edge: int = 0) -> Image.Image:
+    """Open an image from a file path or an in-memory buffer, EXIF-oriented.
+
+    Detection runs on an EXIF-oriented copy, so the renderers must see the
+    same orientation for the normalized boxes to land on the faces. With
+    `max_edge`, a JPEG is decoded at the smallest 1/2^n scale still covering
+    it and the result is downscaled to fit.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        image = Image.open(io.BytesIO(source))
+    else:
+        image = Image.open(source)
+    if max_edge:
+        # Before exif_transpose, which loads the image; the box is square so
+        # the rotation does not matter
+        image.draft("RGB", (max_edge, max_edge))
+    image = ImageOps.exif_transpose(image)
+    if max_edge:
+        image.thumbnail((max_edge, max_edge), Image.BILINEAR)
+    return image
+
+
+@metrics.span("detection_prepare")
+def prepare_for_detection(image_bytes: bytes) -> bytes:
+    """Downscale and re-encode a photo before sending it to Rekognition.
 
-    image = Image.open(image_path)
+    Photos already within the size limit, with no EXIF rotation and in JPEG
+    are sent untouched, and so are those the re-encoding would make bigger.
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    orientation = image.getexif().get(0x0112, 1)  # ExifTags.Base.Orientation
+    if (
+        max(image.size) <= detection_max_edge
+        and orientation == 1
+        and image.format == "JPEG"
+    ):
+        return image_bytes
+
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((detection_max_edge, detection_max_edge), Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.convert("RGB").save(
+        buffer, format="JPEG", quality=detection_jpeg_quality, optimize=True
+    )
+
+    # A barely downscaled JPEG can come out bigger than what Telegram served
+    if orientation == 1 and buffer.tell() >= len(image_bytes):
+        return image_bytes
+    return buffer.getvalue()
+
+
+def image_format_for(extension: str) -> str:
+    """Pillow format name for a file extension, JPEG when unknown."""
+    return Image.registered_extensions().get(f".{extension.lower()}", "JPEG")
+
+
+@metrics.span("encode")
+def _encode(image: Image.Image, spec: EncodingSpec, image_format: str) -> bytes:
+    """Add the black border and encode the image following `spec`."""
+    img_with_border = ImageOps.expand(image, border=border_size, fill=border_fill)
+    return encode_image(img_with_border, spec, image_format)
+
+
+def render_spec(kind: str, mode: str = None, ids_requested: list = ()) -> tuple:
+    """Everything but the photo deciding what a render looks like, for caching.
+
+    `kind` is "reference" or "anonymized" (with its mode and faces).
+    """
+    if kind == "reference":
+        return ("reference", reference_max_edge) + reference_encoding.key()
+    return (
+        "anonymized",
+        mode or default_anonymize_mode,
+        tuple(sorted(ids_requested)),
+    ) + output_encoding.key()
+
+
+def _write_file(file_name: str, content: bytes) -> None:
+    with open(file_name, "wb") as output_file:
+        output_file.write(content)
+
+
+def _in_memory_file(file_name: str, content: bytes) -> io.BytesIO:
+    """Wrap encoded bytes in a named buffer ready to be uploaded."""
+    buffer = io.BytesIO(content)
+    buffer.name = file_name
+    return buffer
+
+
+@metrics.span("reference_render")
+def render_reference(
+    source, boxes: list, image_format: str, max_edge: int = 0
+) -> bytes:
+    """Draw the numbered ellipses of every box and return the encoded image.
+
+    With `max_edge` the preview is drawn at that size. Encoded following
+    REFERENCE_FORMAT, a JPEG by default. Runs in the render pool: arguments and result must be
+    picklable.
+    """
+    image = _open_image(source, max_edge)
     imgWidth, imgHeight = image.size
+    # Labels of small faces must stay readable on the preview
+    min_label_size = 14 if max_edge else 0
+
+    # Every ellipse and label goes on a single overlay, composited once
+    overlay = Image.new("RGBA", image.size, TINT_COLOR + (0,))
+    draw = ImageDraw.Draw(overlay)  # Create a context for drawing things on it.
 
-    for faceDetail in api_response["FaceDetails"]:
-        box = faceDetail["BoundingBox"]
-        left = imgWidth * box["Left"]
-        top = imgHeight * box["Top"]
-        width = imgWidth * box["Width"]
-        height = imgHeight * box["Height"]
+    for counter, box in enumerate(boxes, start=1):
+        left, top, right, bottom = _pixel_box(box, imgWidth, imgHeight)
+        width = right - left
+        height = bottom - top
 
-        image = image.convert("RGBA")
-        overlay = Image.new("RGBA", image.size, TINT_COLOR + (0,))
-        draw = ImageDraw.Draw(overlay)  # Create a context for drawing things on it.
         draw.ellipse(
-            [left, top, left + width, top + height],
+            [left, top, right, bottom],
             outline=reference_color,
             fill=TINT_COLOR + (OPACITY,),
         )
-
-        font = ImageFont.truetype(font_file, int(height * 0.3))
         draw.text(
             (left - width * 0.1, top - height * 0.4),
             str(counter),
             reference_color,
-            font,
+            get_font(quantize_font_size(max(height * 0.3, min_label_size))),
         )
 
-        image = Image.alpha_composite(image, overlay)
-        image = image.convert("RGB")
+    image = Image.alpha_composite(image.convert("RGBA"), overlay).convert("RGB")
+    return _encode(image, reference_encoding, image_format)
 
-        faces[counter] = faceDetail["BoundingBox"]
-        counter += 1
 
-    new_file_name = f"{output_path}/{original_filename}-reference.{original_extension}"
-    img_with_border = ImageOps.expand(image, border=border_size, fill=border_fill)
-    img_with_border.save(new_file_name)
+@metrics.span("blur_render")
+def render_blurred(source, boxes: list, image_format: str, mode: str = "blur") -> bytes:
+    """Anonymize every box and return the encoded image.
 
-    return new_file_name, faces
+    Runs in the render pool: arguments and result must be picklable. Like
+    `render_face_patches`, works in RGB whatever the mode of the photo
+    (grayscale, palette...).
+    """
+    image = _open_image(source).convert("RGB")
+    image = anonymize_faces(image, boxes, mode)
+    return _encode(image, output_encoding, image_format)
 
 
-async def generate_blurred(
+async def generate_reference(
     image_path: str,
     output_path: str,
     original_filename: str,
     original_extension: str,
-    faces_detail: dict,
-    ids_requested: dict,
+    faces: list,
 ) -> str:
-    image = Image.open(image_path)
+    """Number every detected face (FaceBox records) on a copy of the photo.
+
+    `image_path` may also be the photo bytes. With `output_path=None` nothing
+    touches the disk and the encoded image comes back as a BytesIO. The
+    reference is a preview of at most REFERENCE_MAX_EDGE pixels.
+    """
+    faces_detail = {counter: face for counter, face in enumerate(faces, start=1)}
+
+    content = await run_in_render_pool(
+        render_reference,
+        image_path,
+        faces,
+        image_format_for(original_extension),
+        reference_max_edge,
+    )
+
+    extension = reference_encoding.extension(original_extension)
+    new_file_name = f"{original_filename}-reference.{extension}"
+    if output_path is None:
+        return _in_memory_file(new_file_name, content), faces_detail
+
+    new_file_name = f"{output_path}/{new_file_name}"
+    await asyncio.to_thread(_write_file, new_file_name, content)
+
+    return new_file_name, faces_detail
+
+
+def _padded_crop(ellipse: tuple, imgWidth: int, imgHeight: int, padding: int) -> tuple:
+    """Integer crop around an ellipse, grown by `padding` and clamped to the image."""
+    left, top, right, bottom = ellipse
+    return (
+        max(0, int(left) - padding),
+        max(0, int(top) - padding),
+        min(imgWidth, int(right) + 1 + padding),
+        min(imgHeight, int(bottom) + 1 + padding),
+    )
+
+
+def _ellipse_mask(ellipse: tuple, crop: tuple) -> numpy.ndarray:
+    """Boolean mask of an ellipse over an integer crop, evaluated per pixel center."""
+    left, top, right, bottom = ellipse
+    center_x, center_y = (left + right) / 2, (top + bottom) / 2
+    radius_x, radius_y = max((right - left) / 2, 0.5), max((bottom - top) / 2, 0.5)
+    xs = (numpy.arange(crop[0], crop[2]) + 0.5 - center_x) / radius_x
+    ys = (numpy.arange(crop[1], crop[3]) + 0.5 - center_y) / radius_y
+    return ys[:, None] ** 2 + xs[None, :] ** 2 <= 1.0
+
+
+def _anonymize_patch(patch: Image.Image, mode: str) -> Image.Image:
+    """Anonymized copy of a crop around one face."""
+    if mode == "blur":
+        return patch.filter(ImageFilter.GaussianBlur(blur_radius))
+    if mode == "pixelate":
+        cells = (
+            max(1, patch.width * pixelate_blocks // max(patch.width, patch.height)),
+            max(1, patch.height * pixelate_blocks // max(patch.width, patch.height)),
+        )
+        return patch.resize(cells, Image.BOX).resize(patch.size, Image.NEAREST)
+    return Image.new(patch.mode, patch.size, fill_color)
+
+
+def _mode_padding(mode: str) -> int:
+    # Only the blur reads pixels around the face
+    return blur_padding if mode == "blur" else 0
+
+
+def anonymize_faces(image: Image.Image, boxes: list, mode: str = "blur") -> Image.Image:
+    """Anonymize the ellipse (the whole box in box mode) of every box at once.
+
+    Only the padded crop around each face is processed, and the mask is
+    evaluated with NumPy over each face crop of one array that covers the
+    union of those crops, so the cost scales with the faces area instead of
+    faces x image pixels.
+    """
+    if not boxes:
+        return image
+
     imgWidth, imgHeight = image.size
+    padding = _mode_padding(mode)
+    ellipses = [_pixel_box(box, imgWidth, imgHeight) for box in boxes]
+    crops = [
+        _padded_crop(ellipse, imgWidth, imgHeight, padding) for ellipse in ellipses
+    ]
+
+    # Work region: the union of every padded crop
+    region_box = (
+        min(crop[0] for crop in crops),
+        min(crop[1] for crop in crops),
+        max(crop[2] for crop in crops),
+        max(crop[3] for crop in crops),
+    )
+    origin_x, origin_y = region_box[:2]
+    region = image.crop(region_box)
+    anonymized = region.copy()
+    mask = numpy.zeros((region.height, region.width), dtype=bool)
+
+    for ellipse, crop in zip(ellipses, crops):
+        local_crop = (
+            crop[0] - origin_x,
+            crop[1] - origin_y,
+            crop[2] - origin_x,
+            crop[3] - origin_y,
+        )
+        anonymized.paste(
+            _anonymize_patch(region.crop(local_crop), mode), local_crop[:2]
+        )
 
+        face = _padded_crop(ellipse, imgWidth, imgHeight, 0)
+        face_mask = mask[
+            face[1] - origin_y : face[3] - origin_y,
+            face[0] - origin_x : face[2] - origin_x,
+        ]
+        if mode == "box":
+            face_mask[:] = True
+        else:
+            face_mask |= _ellipse_mask(ellipse, face)
+
+    region.paste(anonymized, mask=Image.fromarray(mask.astype(numpy.uint8) * 255, "L"))
+    image.paste(region, region_box[:2])
+    return image
+
+
+@metrics.span("patches_render")
+def render_face_patches(source, boxes: list, mode: str = "blur") -> tuple:
+    """Decode the photo and anonymize every face on its own.
+
+    Returns the decoded base image and, per face, the anonymized patch with
+    its mask and position. Runs in the render pool; PIL images pickle.
+    """
+    image = _open_image(source).convert("RGB")
+    imgWidth, imgHeight = image.size
+    padding = _mode_padding(mode)
+    patches = []
+
+    for box in boxes:
+        ellipse = _pixel_box(box, imgWidth, imgHeight)
+        crop = _padded_crop(ellipse, imgWidth, imgHeight, padding)
+        face = _padded_crop(ellipse, imgWidth, imgHeight, 0)
+        anonymized = _anonymize_patch(image.crop(crop), mode)
+        patch = anonymized.crop(
+            (face[0] - crop[0], face[1] - crop[1], face[2] - crop[0], face[3] - crop[1])
+        )
+
+        if mode == "box":
+            mask = None
+        else:
+            mask = Image.fromarray(
+                _ellipse_mask(ellipse, face).astype(numpy.uint8) * 255, "L"
+            )
+        patches.append((face[:2], patch, mask))
+
+    return image, patches
+
+
+@metrics.span("blur_compose")
+def compose_blurred(
+    face_patches: tuple, ids_requested: list, image_format: str
+) -> bytes:
+    """Paste the precomputed patches of the requested faces and encode."""
+    base, patches = face_patches
+    image = base.copy()
     for id_request in ids_requested:
-        # draw = ImageDraw.Draw(image)
+        position, patch, mask = patches[id_request - 1]
+        image.paste(patch, position, mask)
+    return _encode(image, output_encoding, image_format)
 
-        box = faces_detail[id_request]
-        left = imgWidth * box["Left"]
-        top = imgHeight * box["Top"]
-        width = imgWidth * box["Width"]
-        height = imgHeight * box["Height"]
 
-        # Create rounded rectangle mask
-        mask = Image.new("L", image.size, 0)
-        draw = ImageDraw.Draw(mask)
-        draw.ellipse([left, top, left + width, top + height], fill=255)
+async def generate_blurred(
+    image_path: str,
+    output_path: str,
+    original_filename: str,
+    original_extension: str,
+    faces_detail: dict,
+    ids_requested: dict,
+    face_patches: tuple = None,
+    mode: str = None,
+) -> str:
+    """Anonymize the requested faces, same in-memory rules as generate_reference.
 
-        # Blur image
-        blurred = image.filter(ImageFilter.GaussianBlur(20))
+    `mode` is one of `anonymize_modes`, ANONYMIZE_MODE when not given. When
+    the precomputed `face_patches` of the photo (in that mode) are given,
+    only the composite and the encoding are left to do.
+    """
+    mode = mode or default_anonymize_mode
+    image_format = image_format_for(original_extension)
+    if face_patches is not None:
+        content = await asyncio.to_thread(
+            compose_blurred, face_patches, ids_requested, image_format
+        )
+    else:
+        boxes = [faces_detail[id_request] for id_request in ids_requested]
+        content = await run_in_render_pool(
+            render_blurred, image_path, boxes, image_format, mode
+        )
 
-        # Paste blurred region and save result
-        image.paste(blurred, mask=mask)
+    new_file_name = (
+        f"{original_filename}-blurried.{output_encoding.extension(original_extension)}"
+    )
+    if output_path is None:
+        return _in_memory_file(new_file_name, content)
 
-    new_file_name = f"{output_path}/{original_filename}-blurried.{original_extension}"
-    img_with_border = ImageOps.expand(image, border=border_size, fill=border_fill)
-    img_with_border.save(new_file_name)
+    new_file_name = f"{output_path}/{new_file_name}"
+    await asyncio.to_thread(_write_file, new_file_name, content)
 
     return new_file_name
@@ -0,0 +1,186 @@
+import time
+import bisect
+import logging
+import threading
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from a cache hit to a slow Rekognition call
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    """Cumulative latency histogram of one stage, Prometheus style."""
+
+    def __init__(self, buckets: tuple = latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the given quantile."""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Registry:
+    """Stage histograms, counters and gauges of the bot process.
+
+    Stage spans and counters recorded inside a render worker are collected
+    per job (see `start_job` / `finish_job`) and replayed here by the parent.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+        self._job_timings = None
+        self._job_counters = None
+
+    def observe(self, stage: str, seconds: float) -> None:
+        if self._job_timings is not None:
+            self._job_timings[stage] = self._job_timings.get(stage, 0.0) + seconds
+            return
+        with self._lock:
+            self.stages.setdefault(stage, Histogram()).observe(seconds)
+
+    def increment(self, name: str, amount: float = 1) -> None:
+        if self._job_counters is not None:
+            self._job_counters[name] = self._job_counters.get(name, 0) + amount
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name: str, description: str, callback) -> None:
+        """Register a gauge read from `callback` at scrape time.
+
+        `name` may carry Prometheus labels, e.g. 'in_flight{endpoint="a"}'.
+        """
+        self.gauges[name] = (description, callback)
+
+    @contextmanager
+    def span(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def start_job(self) -> None:
+        self._job_timings = {}
+        self._job_counters = {}
+
+    def finish_job(self) -> tuple:
+        """Stage timings and counter increments of the job, for the parent."""
+        timings, self._job_timings = self._job_timings or {}, None
+        counters, self._job_counters = self._job_counters or {}, None
+        return timings, counters
+
+    def _gauge_values(self) -> dict:
+        values = {}
+        for name, (description, callback) in self.gauges.items():
+            try:
+                values[name] = (description, float(callback()))
+            except Exception as e:
+                logger.warning(f"Gauge {name} failed: {str(e)}")
+        return values
+
+    def render_prometheus(self) -> str:
+        """Prometheus text exposition format."""
+        lines = [
+            "# HELP facebot_stage_seconds Latency of each pipeline stage.",
+            "# TYPE facebot_stage_seconds histogram",
+        ]
+        with self._lock:
+            for stage, histogram in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets, histogram.counts):
+                    cumulative += bucket_count
+                    lines.append(
+                        f'facebot_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}'
+                    )
+                lines.append(
+                    f'facebot_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}'
+                )
+                lines.append(
+                    f'facebot_stage_seconds_sum{{stage="{stage}"}} {histogram.total}'
+                )
+                lines.append(
+                    f'facebot_stage_seconds_count{{stage="{stage}"}} {histogram.count}'
+                )
+            counters = dict(self.counters)
+
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE facebot_{name}_total counter")
+            lines.append(f"facebot_{name}_total {value}")
+
+        # Labelled gauges ('name{label="value"}') share one HELP / TYPE header
+        described = set()
+        for name, (description, value) in sorted(self._gauge_values().items()):
+            base_name = name.split("{", 1)[0]
+            if base_name not in described:
+                described.add(base_name)
+                lines.append(f"# HELP facebot_{base_name} {description}")
+                lines.append(f"# TYPE facebot_{base_name} gauge")
+            lines.append(f"facebot_{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """One line per stage for the periodic log."""
+        with self._lock:
+            parts = [
+                f"{stage}: n={histogram.count} avg={histogram.total / histogram.count * 1000:.0f}ms "
+                f"p50<={histogram.quantile(0.5) * 1000:.0f}ms p99<={histogram.quantile(0.99) * 1000:.0f}ms"
+                for stage, histogram in sorted(self.stages.items())
+                if histogram.count
+            ]
+        parts += [
+            f"{name}={value:g}"
+            for name, (_, value) in sorted(self._gauge_values().items())
+        ]
+        return " | ".join(parts)
+
+
+metrics = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve /metrics from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return server
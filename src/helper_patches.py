@@ -0,0 +1,116 @@
+import os
+import asyncio
+import logging
+
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+from helper_images import default_anonymize_mode, render_face_patches
+from helper_metrics import metrics
+from helper_render import run_in_render_pool
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+class FacePatchCache:
+    """LRU of decoded photos with their per-face anonymized patches.
+
+    The patches of a photo are computed by its first anonymization request,
+    under that request's admission ticket, so follow-up requests ("1,3",
+    then "1,3,4", then "all") only composite them. Entries are per photo and
+    anonymization mode and hold a decoded image: the cache keeps at most
+    `budget` bytes of them, and drops those of a user folder along with it
+    (`discard_folder`).
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.size = 0
+        # (file_id, mode) -> [patches task, bytes once done, folder]
+        self._entries = OrderedDict()
+
+    async def get(
+        self,
+        file_id: str,
+        image_source,
+        boxes: list,
+        mode: str = None,
+        folder: str = None,
+    ):
+        """Patches of a photo stored under `folder`, computed if needed.
+
+        None when disabled or failed.
+        """
+        key = (file_id, mode or default_anonymize_mode)
+        if self.budget <= 0:
+            return None
+
+        entry = self._entries.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(
+                run_in_render_pool(render_face_patches, image_source, boxes, key[1])
+            )
+            entry = self._entries[key] = [task, 0, folder]
+        self._entries.move_to_end(key)
+
+        task = entry[0]
+        try:
+            patches = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            return None
+        except Exception as e:
+            logger.error(f"Face patches of {file_id} failed: {str(e)}")
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+            return None
+
+        if not entry[1] and self._entries.get(key) is entry:
+            entry[1] = _patches_bytes(patches)
+            self.size += entry[1]
+            self._evict()
+        return patches
+
+    def _evict(self) -> None:
+        """Drop the least recently used patches (done ones) beyond the budget."""
+        for key in list(self._entries):
+            if self.size <= self.budget:
+                break
+            size = self._entries[key][1]
+            if size:
+                del self._entries[key]
+                self.size -= size
+
+    def discard_folder(self, folder_path: str) -> None:
+        """Drop the patches of every photo stored under a folder.
+
+        Patches still being computed are not kept once done.
+        """
+        for key, (_, size, folder) in list(self._entries.items()):
+            if folder == folder_path:
+                del self._entries[key]
+                self.size -= size
+
+
+def _patches_bytes(face_patches: tuple) -> int:
+    base, patches = face_patches
+    images = [base] + [image for _, patch, mask in patches for image in (patch, mask)]
+    return sum(
+        image.width * image.height * len(image.getbands())
+        for image in images
+        if image is not None
+    )
+
+
+face_patches = FacePatchCache(
+    budget=int(os.getenv("FACE_PATCH_CACHE_BUDGET", str(256 * 1024 * 1024)))
+)
+metrics.gauge(
+    "face_patch_cache_bytes",
+    "Decoded photos and face patches kept for follow-up requests.",
+    lambda: face_patches.size,
+)
@@ -0,0 +1,303 @@
+import os
+import json
+import pickle
+import asyncio
+import logging
+import sqlite3
+import threading
+import boto3
+
+from dotenv import load_dotenv
+from boto3.dynamodb.conditions import Attr
+from telegram.ext import BasePersistence, PersistenceInput
+
+from helper_dynamo import dynamodb_config
+from helper_resilience import aws_retryable, stage_from_env
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+class KeyValuePersistence(BasePersistence):
+    """Persistence of user_data, chat_data, bot_data and conversation states.
+
+    Every value is pickled under a (kind, key) pair; subclasses only provide
+    the blocking storage calls, run here in a thread. Values are pickled on
+    the event loop so what gets written is a snapshot. Writes are immediate,
+    `flush` has nothing left to do. Callback data is not stored.
+
+    `load_user_data` / `load_conversation` read one entry back, for the
+    instances sharing the store (see SHARED_STATE in bot.py). With `shared`,
+    PTB neither loads everything at startup nor writes back periodically:
+    its copy may be older than what another instance stored, the bot reads
+    and writes the entries of a user around each of their updates instead.
+    Backends without `bulk_load` are also read one user at a time, on the
+    first update of each user; chat_data, unused by the bot, is not kept
+    then.
+
+    Single entry reads and writes, the ones on the path of an update, run
+    under `stage` (deadline, retries and circuit breaker) when given.
+    """
+
+    # Whether reading every entry of a kind at startup is cheap
+    bulk_load = True
+
+    def __init__(self, update_interval: float = 60, stage=None, shared: bool = False):
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=not shared,
+                chat_data=not shared and self.bulk_load,
+                user_data=not shared,
+                callback_data=False,
+            ),
+            update_interval=update_interval,
+        )
+        self.stage = stage
+        self.shared = shared
+
+    @property
+    def lazy(self) -> bool:
+        """Entries are read on the first update of each user, not at startup."""
+        return self.shared or not self.bulk_load
+
+    # Storage, blocking
+    def _read_all(self, kind: str) -> dict:
+        raise NotImplementedError
+
+    def _read(self, kind: str, key: str):
+        raise NotImplementedError
+
+    def _write(self, kind: str, key: str, value: bytes) -> None:
+        raise NotImplementedError
+
+    def _delete(self, kind: str, key: str) -> None:
+        raise NotImplementedError
+
+    # Helpers
+    async def _load_all(self, kind: str) -> dict:
+        entries = await asyncio.to_thread(self._read_all, kind)
+        return {key: pickle.loads(value) for key, value in entries.items()}
+
+    async def _call(self, function, *args):
+        if self.stage is None:
+            return await asyncio.to_thread(function, *args)
+        return await self.stage.call(asyncio.to_thread, function, *args)
+
+    async def _load(self, kind: str, key: str):
+        value = await self._call(self._read, kind, key)
+        return None if value is None else pickle.loads(value)
+
+    async def _store(self, kind: str, key: str, data) -> None:
+        await self._call(
+            self._write, kind, key, pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        )
+
+    @staticmethod
+    def _conversation_key(key: tuple) -> str:
+        return json.dumps(list(key))
+
+    # BasePersistence
+    async def get_user_data(self) -> dict:
+        if self.lazy:
+            return {}
+        return {
+            int(key): value for key, value in (await self._load_all("user")).items()
+        }
+
+    async def get_chat_data(self) -> dict:
+        if self.lazy:
+            return {}
+        return {
+            int(key): value for key, value in (await self._load_all("chat")).items()
+        }
+
+    async def get_bot_data(self) -> dict:
+        return await self._load("bot", "bot") or {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        if self.lazy:
+            return {}
+        conversations = await self._load_all(f"conversation:{name}")
+        return {tuple(json.loads(key)): state for key, state in conversations.items()}
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        if not self.shared:
+            await self.store_conversation(name, key, new_state)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        await self.store_user_data(user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        await self._store("chat", str(chat_id), data)
+
+    async def update_bot_data(self, data: dict) -> None:
+        await self._store("bot", "bot", data)
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._call(self._delete, "chat", str(chat_id))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._call(self._delete, "user", str(user_id))
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass
+
+    # Per user reads and writes, outside of PTB's periodic ones
+    async def store_conversation(self, name: str, key: tuple, new_state) -> None:
+        if new_state is None:
+            await self._call(
+                self._delete, f"conversation:{name}", self._conversation_key(key)
+            )
+        else:
+            await self._store(
+                f"conversation:{name}", self._conversation_key(key), new_state
+            )
+
+    async def store_user_data(self, user_id: int, data: dict) -> None:
+        await self._store("user", str(user_id), data)
+
+    async def load_user_data(self, user_id: int):
+        return await self._load("user", str(user_id))
+
+    async def load_conversation(self, name: str, key: tuple):
+        return await self._load(f"conversation:{name}", self._conversation_key(key))
+
+
+class SQLitePersistence(KeyValuePersistence):
+    """Local file backend, one SQLite table shared by the instances of a host."""
+
+    def __init__(
+        self, path: str, update_interval: float = 60, stage=None, shared: bool = False
+    ):
+        super().__init__(update_interval=update_interval, stage=stage, shared=shared)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS state (kind TEXT, key TEXT, value BLOB, PRIMARY KEY (kind, key))"
+        )
+        self._lock = threading.Lock()
+
+    def _read_all(self, kind: str) -> dict:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT key, value FROM state WHERE kind = ?", (kind,)
+            ).fetchall()
+        return dict(rows)
+
+    def _read(self, kind: str, key: str):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM state WHERE kind = ? AND key = ?", (kind, key)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _write(self, kind: str, key: str, value: bytes) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO state (kind, key, value) VALUES (?, ?, ?)",
+                (kind, key, value),
+            )
+
+    def _delete(self, kind: str, key: str) -> None:
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM state WHERE kind = ? AND key = ?", (kind, key)
+            )
+
+
+class DynamoPersistence(KeyValuePersistence):
+    """DynamoDB backend, for instances spread over several hosts.
+
+    The table has a string partition key `key`; items are `<kind>#<key>`
+    with the pickled value in the binary attribute `value`. Reading a whole
+    kind back is a Scan of the table, so entries are read per user instead.
+    """
+
+    bulk_load = False
+
+    def __init__(
+        self, table, update_interval: float = 60, stage=None, shared: bool = False
+    ):
+        super().__init__(update_interval=update_interval, stage=stage, shared=shared)
+        self.table = table
+
+    def _read_all(self, kind: str) -> dict:
+        prefix = f"{kind}#"
+        entries = {}
+        scan_arguments = {"FilterExpression": Attr("key").begins_with(prefix)}
+        while True:
+            response = self.table.scan(**scan_arguments)
+            for item in response["Items"]:
+                entries[item["key"][len(prefix) :]] = bytes(item["value"])
+            if "LastEvaluatedKey" not in response:
+                return entries
+            scan_arguments["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def _read(self, kind: str, key: str):
+        item = self.table.get_item(Key={"key": f"{kind}#{key}"}).get("Item")
+        return bytes(item["value"]) if item else None
+
+    def _write(self, kind: str, key: str, value: bytes) -> None:
+        self.table.put_item(Item={"key": f"{kind}#{key}", "value": value})
+
+    def _delete(self, kind: str, key: str) -> None:
+        self.table.delete_item(Key={"key": f"{kind}#{key}"})
+
+
+def create_persistence(shared: bool = False):
+    """Conversation persistence selected with PERSISTENCE_BACKEND, None when disabled.
+
+    `shared` when several instances use it at once (SHARED_STATE).
+    """
+    backend = os.getenv("PERSISTENCE_BACKEND", "none")
+    update_interval = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "60"))
+
+    if backend == "none":
+        return None
+    if backend == "sqlite":
+        stage = stage_from_env(
+            "state_store",
+            "sqlite",
+            timeout=5,
+            attempts=2,
+            retryable=lambda error: isinstance(error, sqlite3.OperationalError),
+        )
+        return SQLitePersistence(
+            os.getenv("PERSISTENCE_FILE", "state/bot.sqlite3"),
+            update_interval,
+            stage,
+            shared,
+        )
+    if backend == "dynamodb":
+        endpoint_url = os.getenv("DYNAMODB_ENDPOINT_URL") or None
+        table = boto3.resource(
+            "dynamodb", endpoint_url=endpoint_url, config=dynamodb_config
+        ).Table(os.getenv("PERSISTENCE_TABLE"))
+        stage = stage_from_env(
+            "state_store", "dynamodb", timeout=5, attempts=2, retryable=aws_retryable
+        )
+        return DynamoPersistence(table, update_interval, stage, shared)
+
+    raise ValueError(
+        f"Unknown PERSISTENCE_BACKEND {backend!r}, expected none, sqlite or dynamodb"
+    )
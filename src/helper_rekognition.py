@@ -0,0 +1,214 @@
+import time
+import random
+import logging
+import threading
+import boto3
+import botocore
+
+from helper_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Errors meaning "this endpoint is saturated", worth trying another one
+throttling_errors = {
+    "ThrottlingException",
+    "ProvisionedThroughputExceededException",
+    "LimitExceededException",
+    "ServiceUnavailableException",
+}
+
+
+def parse_endpoints(value: str) -> list:
+    """REKOGNITION_ENDPOINTS: entries separated by ",", fields by ";".
+
+    Example: "region=eu-west-1,region=us-east-1;profile=second-account,
+    region=eu-west-1;endpoint_url=http://127.0.0.1:9001". An empty value is
+    one client with the default region and credentials.
+    """
+    endpoints = []
+    for entry in value.split(","):
+        fields = dict(field.split("=", 1) for field in entry.split(";") if "=" in field)
+        fields = {
+            key.strip(): field.strip() for key, field in fields.items() if field.strip()
+        }
+        if fields:
+            endpoints.append(fields)
+    return endpoints or [{}]
+
+
+class PooledClient:
+    """One Rekognition client of the pool, with its load and health."""
+
+    def __init__(self, name: str, client):
+        self.name = name
+        self.client = client
+        self.in_flight = 0
+        self.latency = None  # EWMA, seconds
+        self.throttles = 0
+        self.backoff_until = 0.0
+
+    def observe(self, seconds: float, alpha: float = 0.2) -> None:
+        self.latency = (
+            seconds
+            if self.latency is None
+            else alpha * seconds + (1 - alpha) * self.latency
+        )
+
+
+class RekognitionPool:
+    """DetectFaces over several regions and accounts, as if it was one client.
+
+    Each call goes to the available client with the fewest calls in flight
+    (`least_in_flight`) or the lowest expected wait, EWMA latency x load
+    (`latency`). A throttled or unreachable client is put in exponential
+    backoff (with jitter) and the call moves on to the next one.
+    """
+
+    def __init__(
+        self,
+        clients: list,
+        strategy: str = "least_in_flight",
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+    ):
+        if strategy not in ("least_in_flight", "latency"):
+            raise ValueError(f"Unknown REKOGNITION_POOL_STRATEGY {strategy!r}")
+        self.clients = clients
+        self.strategy = strategy
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+
+        for pooled in clients:
+            metrics.gauge(
+                f'rekognition_in_flight{{endpoint="{pooled.name}"}}',
+                "DetectFaces calls in flight per endpoint.",
+                lambda pooled=pooled: pooled.in_flight,
+            )
+            metrics.gauge(
+                f'rekognition_latency_ewma_seconds{{endpoint="{pooled.name}"}}',
+                "Smoothed DetectFaces latency per endpoint.",
+                lambda pooled=pooled: pooled.latency or 0.0,
+            )
+
+    def _score(self, pooled: PooledClient) -> float:
+        if self.strategy == "latency":
+            # Unmeasured clients go first, so every endpoint gets measured
+            return (pooled.latency or 0.0) * (pooled.in_flight + 1)
+        return pooled.in_flight
+
+    def _acquire(self, tried: set) -> PooledClient:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [pooled for pooled in self.clients if pooled not in tried]
+            if not candidates:
+                return None
+            available = [pooled for pooled in candidates if pooled.backoff_until <= now]
+            if available:
+                pooled = min(available, key=self._score)
+            else:
+                # Everyone is backing off: the one closest to recovery
+                pooled = min(candidates, key=lambda candidate: candidate.backoff_until)
+            pooled.in_flight += 1
+            return pooled
+
+    def _release(
+        self, pooled: PooledClient, seconds: float = None, throttled: bool = False
+    ) -> None:
+        with self._lock:
+            pooled.in_flight -= 1
+            if seconds is not None:
+                pooled.observe(seconds)
+            if throttled:
+                pooled.throttles += 1
+                delay = min(
+                    self.backoff_max,
+                    self.backoff_base * 2 ** min(pooled.throttles - 1, 16),
+                )
+                pooled.backoff_until = time.monotonic() + random.uniform(
+                    delay / 2, delay
+                )
+            elif seconds is not None:
+                pooled.throttles = 0
+
+    def detect_faces(self, **kwargs) -> dict:
+        tried = set()
+        last_error = None
+        while True:
+            pooled = self._acquire(tried)
+            if pooled is None:
+                # Every client failed over: report the last throttling error
+                raise last_error
+            tried.add(pooled)
+
+            start = time.perf_counter()
+            try:
+                response = pooled.client.detect_faces(**kwargs)
+            except botocore.exceptions.ClientError as e:
+                code = e.response.get("Error", {}).get("Code")
+                self._release(pooled, throttled=code in throttling_errors)
+                if code not in throttling_errors:
+                    raise
+                last_error = e
+            except (
+                botocore.exceptions.EndpointConnectionError,
+                botocore.exceptions.ConnectTimeoutError,
+            ) as e:
+                self._release(pooled, throttled=True)
+                last_error = e
+            except Exception:
+                self._release(pooled)
+                raise
+            else:
+                seconds = time.perf_counter() - start
+                self._release(pooled, seconds)
+                metrics.observe(f"rekognition@{pooled.name}", seconds)
+                return response
+
+            metrics.increment("rekognition_failovers")
+            logger.warning(
+                f"Rekognition {pooled.name} throttled or unreachable ({str(last_error)}), failing over"
+            )
+
+
+def create_rekognition_pool(
+    endpoints: list,
+    config,
+    strategy: str = "least_in_flight",
+    backoff_base: float = 1.0,
+    backoff_max: float = 60.0,
+) -> RekognitionPool:
+    """Build the pool from parsed REKOGNITION_ENDPOINTS entries.
+
+    `config` is used as is by every client, retries included: with a single
+    attempt per call (see helper_aws), a throttled endpoint fails over at
+    once instead of being retried.
+    """
+    clients = []
+    for index, endpoint in enumerate(endpoints):
+        session = boto3.session.Session(
+            profile_name=endpoint.get("profile"),
+            region_name=endpoint.get("region"),
+        )
+        client = session.client(
+            "rekognition", config=config, endpoint_url=endpoint.get("endpoint_url")
+        )
+        name = (
+            endpoint.get("name")
+            or "/".join(
+                part
+                for part in (
+                    client.meta.region_name,
+                    endpoint.get("profile"),
+                    endpoint.get("endpoint_url"),
+                )
+                if part
+            )
+            or str(index)
+        )
+        clients.append(PooledClient(name, client))
+
+    logger.info(f"Rekognition pool: {[pooled.name for pooled in clients]} ({strategy})")
+    return RekognitionPool(
+        clients, strategy=strategy, backoff_base=backoff_base, backoff_max=backoff_max
+    )
@@ -0,0 +1,116 @@
+import os
+import asyncio
+import logging
+import multiprocessing
+
+from dotenv import load_dotenv
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from helper_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Pillow work is CPU bound: render in worker processes so every core is used
+# and the event loop never waits behind an image being blurred.
+render_workers = int(os.getenv("RENDER_WORKERS") or os.cpu_count() or 1)
+_render_executor = None
+_jobs_in_flight = 0
+
+metrics.gauge(
+    "render_jobs_in_flight",
+    "Render jobs queued or running in the pool.",
+    lambda: _jobs_in_flight,
+)
+metrics.gauge("render_workers", "Size of the render pool.", lambda: render_workers)
+
+
+def get_render_executor() -> ProcessPoolExecutor:
+    """Lazily start the render pool (see `warm_up_render_pool`).
+
+    Workers come from a fork server, not forked from the bot: a fork would
+    copy the locks the bot's threads (detection pool, metrics server) hold.
+    """
+    global _render_executor
+    if _render_executor is None:
+        _render_executor = ProcessPoolExecutor(
+            max_workers=render_workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+        logger.info(f"Render pool started with {render_workers} worker(s)")
+    return _render_executor
+
+
+def _replace_broken_executor(broken: ProcessPoolExecutor) -> None:
+    """Drop a pool that lost a worker (OOM kill...), the next job starts a new one."""
+    global _render_executor
+    if _render_executor is broken:
+        _render_executor = None
+        broken.shutdown(wait=False)
+        metrics.increment("render_pool_restarts")
+        logger.warning("Render pool broken by a dead worker, restarting it")
+
+
+def _warm_up() -> None:
+    pass
+
+
+async def warm_up_render_pool() -> None:
+    """Start every render worker now rather than on the first photos."""
+    loop = asyncio.get_running_loop()
+    executor = get_render_executor()
+    await asyncio.gather(
+        *(loop.run_in_executor(executor, _warm_up) for _ in range(render_workers))
+    )
+
+
+def _run_job(func, *args):
+    """Worker side: run the job and return its result with its metrics."""
+    metrics.start_job()
+    try:
+        result = func(*args)
+    finally:
+        job_metrics = metrics.finish_job()
+    return result, job_metrics
+
+
+async def run_in_render_pool(func, *args):
+    """Run a picklable render job in the pool and await its encoded result.
+
+    A job caught in a broken pool is run once more in a new one.
+    """
+    global _jobs_in_flight
+    loop = asyncio.get_running_loop()
+    _jobs_in_flight += 1
+    try:
+        executor = get_render_executor()
+        try:
+            result, (timings, counters) = await loop.run_in_executor(
+                executor, _run_job, func, *args
+            )
+        except BrokenProcessPool:
+            _replace_broken_executor(executor)
+            result, (timings, counters) = await loop.run_in_executor(
+                get_render_executor(), _run_job, func, *args
+            )
+    finally:
+        _jobs_in_flight -= 1
+
+    # Stage spans and counters recorded inside the worker land in this
+    # process' metrics
+    for stage, seconds in timings.items():
+        metrics.observe(stage, seconds)
+    for name, amount in counters.items():
+        metrics.increment(name, amount)
+    return result
+
+
+def shutdown_render_pool() -> None:
+    """Stop the render workers, waiting for the jobs already submitted."""
+    global _render_executor
+    if _render_executor is not None:
+        _render_executor.shutdown(wait=True)
+        _render_executor = None
@@ -0,0 +1,288 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import botocore
+
+from collections import deque
+from dotenv import load_dotenv
+from telegram.error import BadRequest, NetworkError
+
+from helper_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables from .env file
+load_dotenv()
+
+# A dependency failing this many calls in a row is considered down, and
+# is left alone for BREAKER_RESET_TIMEOUT seconds before one probe call.
+breaker_failures = int(os.getenv("BREAKER_FAILURES", "5"))
+breaker_reset_timeout = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_state_values = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class DependencyUnavailable(Exception):
+    """A dependency did not answer in time, or kept failing: tell the user to retry later."""
+
+    def __init__(self, dependency: str, message: str = None):
+        super().__init__(message or f"{dependency} is unavailable")
+        self.dependency = dependency
+
+
+class CircuitOpen(DependencyUnavailable):
+    """The dependency is known to be down, the call was not even tried."""
+
+
+def aws_retryable(error: Exception) -> bool:
+    """Connection problems, timeouts, throttling and 5xx answers of an AWS service."""
+    if isinstance(
+        error,
+        (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError),
+    ):
+        return True
+    if isinstance(error, botocore.exceptions.ClientError):
+        code = error.response.get("Error", {}).get("Code", "")
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return (
+            status >= 500
+            or "Throttl" in code
+            or code
+            in ("ProvisionedThroughputExceededException", "RequestLimitExceeded")
+        )
+    return False
+
+
+def telegram_retryable(error: Exception) -> bool:
+    """Timeouts and network errors of the Bot API, not the requests it refused."""
+    return isinstance(error, NetworkError) and not isinstance(error, BadRequest)
+
+
+class CircuitBreaker:
+    """Health of one dependency, shared by every stage calling it.
+
+    Closed: calls go through. After `failure_threshold` failures in a row it
+    opens and calls fail fast with CircuitOpen. After `reset_timeout` it is
+    half open: one probe call goes through, its outcome closes or re-opens it.
+    All calls happen on the event loop, no locking needed.
+    """
+
+    def __init__(
+        self, name: str, failure_threshold: int = 5, reset_timeout: float = 30
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+        metrics.gauge(
+            f'circuit_state{{dependency="{name}"}}',
+            "Circuit breaker per dependency: 0 closed, 1 half open, 2 open.",
+            lambda: _state_values[self.state],
+        )
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def success(self) -> None:
+        if self.opened_at is not None:
+            logger.info(f"Circuit {self.name} closed, the dependency answers again")
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def abandon(self) -> None:
+        """The call was cancelled before an outcome: let another one probe."""
+        self._probing = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self._probing or (
+            self.opened_at is None and self.failures >= self.failure_threshold
+        ):
+            if self.opened_at is None:
+                metrics.increment("circuit_opened")
+            logger.warning(
+                f"Circuit {self.name} open after {self.failures} failure(s), failing fast"
+            )
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+
+breakers = {}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """The breaker of a dependency, created on first use."""
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(name, breaker_failures, breaker_reset_timeout)
+    return breakers[name]
+
+
+class Stage:
+    """Deadline, retries and hedging of one kind of call to a dependency.
+
+    Each attempt gets `timeout` seconds; timeouts and errors accepted by
+    `retryable` count against the breaker and are retried up to `attempts`
+    times with jittered exponential backoff, then surface as
+    DependencyUnavailable. Any other error is the caller's problem and
+    passes through untouched.
+
+    With `hedge_percentile` set, an attempt still running after that
+    percentile of the recent latencies gets a second, concurrent request;
+    the first answer wins and the other one is cancelled. Only for
+    idempotent calls.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        breaker: CircuitBreaker,
+        timeout: float,
+        attempts: int = 1,
+        backoff: float = 0.2,
+        retryable=None,
+        hedge_percentile: float = 0,
+        hedge_min_samples: int = 20,
+    ):
+        self.name = name
+        self.breaker = breaker
+        self.timeout = timeout
+        self.attempts = max(1, attempts)
+        self.backoff = backoff
+        self.retryable = retryable or (lambda error: False)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = deque(maxlen=256)
+
+    def hedge_delay(self):
+        """Seconds before a hedged request, None when hedging is off or not calibrated yet."""
+        if not self.hedge_percentile or len(self.latencies) < self.hedge_min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[
+            min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))
+        ]
+
+    async def _attempt(self, operation, args, kwargs):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        tasks = [asyncio.ensure_future(operation(*args, **kwargs))]
+        try:
+            delay = self.hedge_delay()
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    metrics.increment(f"{self.name}_hedged")
+                    tasks.append(asyncio.ensure_future(operation(*args, **kwargs)))
+
+            pending = set(tasks)
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                winner = next((task for task in done if task.exception() is None), None)
+                if winner is not None:
+                    if winner is not tasks[0]:
+                        metrics.increment(f"{self.name}_hedge_wins")
+                    self.latencies.append(loop.time() - start)
+                    return winner.result()
+                if not pending:
+                    # Both requests failed: report the original one
+                    return (
+                        tasks[0].result()
+                        if tasks[0].done()
+                        else next(iter(done)).result()
+                    )
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def call(self, operation, *args, **kwargs):
+        """Run `await operation(*args, **kwargs)` under this stage's policy.
+
+        `operation` is called again for every attempt, so it must build a
+        fresh awaitable each time (a coroutine function or a lambda).
+        """
+        if not self.breaker.allow():
+            metrics.increment(f"{self.name}_rejected")
+            raise CircuitOpen(self.breaker.name)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = await asyncio.wait_for(
+                    self._attempt(operation, args, kwargs), self.timeout
+                )
+            except asyncio.TimeoutError as e:
+                metrics.increment(f"{self.name}_timeouts")
+                error = e
+            except asyncio.CancelledError:
+                self.breaker.abandon()
+                raise
+            except Exception as e:
+                if not self.retryable(e):
+                    # The dependency answered, the request itself was wrong
+                    self.breaker.success()
+                    raise
+                error = e
+            else:
+                self.breaker.success()
+                return result
+
+            self.breaker.failure()
+            if attempt >= self.attempts or not self.breaker.allow():
+                raise DependencyUnavailable(
+                    self.breaker.name,
+                    f"{self.name} failed after {attempt} attempt(s): {error!r}",
+                ) from error
+
+            metrics.increment(f"{self.name}_retries")
+            delay = self.backoff * 2 ** (attempt - 1)
+            logger.info(
+                f"{self.name} attempt {attempt} failed ({error!r}), retrying in ~{delay:.2f}s"
+            )
+            await asyncio.sleep(random.uniform(delay / 2, delay))
+
+
+def stage_from_env(
+    name: str,
+    dependency: str,
+    timeout: float,
+    attempts: int = 1,
+    retryable=None,
+    hedge: bool = False,
+) -> Stage:
+    """A stage configured by <NAME>_TIMEOUT, <NAME>_ATTEMPTS (and <NAME>_HEDGE_PERCENTILE)."""
+    prefix = name.upper()
+    return Stage(
+        name,
+        get_breaker(dependency),
+        timeout=float(os.getenv(f"{prefix}_TIMEOUT", str(timeout))),
+        attempts=int(os.getenv(f"{prefix}_ATTEMPTS", str(attempts))),
+        retryable=retryable,
+        hedge_percentile=(
+            float(os.getenv(f"{prefix}_HEDGE_PERCENTILE", "0")) if hedge else 0
+        ),
+    )
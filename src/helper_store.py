@@ -0,0 +1,193 @@
+import os
+import asyncio
+import logging
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Kinds of files under TMP_FOLDER. Derived files can be rendered again from
+# the original, so they are evicted first.
+ORIGINAL = "original"
+DERIVED = "derived"
+
+
+def _write_file(file_name: str, content: bytes) -> None:
+    os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+    with open(file_name, "wb") as output_file:
+        output_file.write(content)
+
+
+def _remove_file(file_name: str) -> None:
+    try:
+        os.remove(file_name)
+    except FileNotFoundError:
+        pass
+
+
+def _read_file(file_name: str):
+    try:
+        with open(file_name, "rb") as input_file:
+            return input_file.read()
+    except FileNotFoundError:
+        return None
+
+
+class MemoryStore:
+    """Photo buffers kept in memory, keyed by the path they would have on disk.
+
+    The store is bounded by `budget` bytes. When a new buffer does not fit, the
+    least recently used buffers are spilled to their path under TMP_FOLDER and
+    read back from there on demand, so disk is only a spill tier.
+    """
+
+    def __init__(self, budget: int, disk_store=None):
+        self.budget = budget
+        self.used = 0
+        self.disk_store = disk_store
+        self._buffers = OrderedDict()
+
+    def __contains__(self, path: str) -> bool:
+        return path in self._buffers
+
+    async def put(self, path: str, content: bytes) -> None:
+        self.discard(path)
+        self._buffers[path] = content
+        self.used += len(content)
+
+        spills = []
+        while self.used > self.budget and len(self._buffers) > 1:
+            spill_path, spill_content = self._buffers.popitem(last=False)
+            self.used -= len(spill_content)
+            spills.append((spill_path, spill_content))
+
+        for spill_path, spill_content in spills:
+            logger.info(f"Spilling {spill_path} ({len(spill_content)} bytes) to disk")
+            await asyncio.to_thread(_write_file, spill_path, spill_content)
+            if self.disk_store is not None:
+                await self.disk_store.add(spill_path, ORIGINAL, len(spill_content))
+
+    async def get(self, path: str):
+        """Return the buffer for a path, from memory or from the spill tier."""
+        content = self._buffers.get(path)
+        if content is not None:
+            self._buffers.move_to_end(path)
+            return content
+        if self.disk_store is not None:
+            self.disk_store.touch(path)
+        return await asyncio.to_thread(_read_file, path)
+
+    def discard_folder(self, folder_path: str) -> None:
+        """Drop every buffer stored under a folder."""
+        prefix = folder_path.rstrip("/") + "/"
+        for path in [path for path in self._buffers if path.startswith(prefix)]:
+            self.discard(path)
+
+    def discard(self, path: str) -> None:
+        content = self._buffers.pop(path, None)
+        if content is not None:
+            self.used -= len(content)
+
+
+class DiskStore:
+    """Byte budget for the files written under TMP_FOLDER.
+
+    Files are tracked in least recently used order, per kind. Once `budget` is
+    exceeded, derived files (-reference / -blurried) are deleted first and
+    originals only when no derived file is left. Evicted paths are remembered
+    so the bot can tell an eviction from an age based cleanup.
+    """
+
+    def __init__(self, budget: int, remembered_evictions: int = 4096):
+        self.budget = budget
+        self.used = 0
+        self.evictions = 0
+        self._files = {ORIGINAL: OrderedDict(), DERIVED: OrderedDict()}
+        self._evicted = OrderedDict()
+        self._remembered_evictions = remembered_evictions
+
+    @staticmethod
+    def kind_of(path: str) -> str:
+        name = os.path.basename(path)
+        if "-reference." in name or "-blurried." in name or name.endswith(".json"):
+            return DERIVED
+        return ORIGINAL
+
+    def usage(self) -> dict:
+        return {
+            "budget": self.budget,
+            "used": self.used,
+            "originals": len(self._files[ORIGINAL]),
+            "derived": len(self._files[DERIVED]),
+            "evictions": self.evictions,
+        }
+
+    async def add(self, path: str, kind: str = None, size: int = None) -> None:
+        """Track a file just written, then evict until back within budget."""
+        kind = kind or self.kind_of(path)
+        if size is None:
+            size = await asyncio.to_thread(os.path.getsize, path)
+
+        self._forget(path)
+        self._evicted.pop(path, None)
+        self._files[kind][path] = size
+        self.used += size
+        await self.enforce()
+
+    def touch(self, path: str) -> None:
+        for files in self._files.values():
+            if path in files:
+                files.move_to_end(path)
+
+    def was_evicted(self, path: str) -> bool:
+        return path in self._evicted
+
+    def _forget(self, path: str) -> None:
+        for files in self._files.values():
+            size = files.pop(path, None)
+            if size is not None:
+                self.used -= size
+
+    def forget_folder(self, folder_path: str) -> None:
+        """Stop tracking a folder deleted by the age based cleanup."""
+        prefix = folder_path.rstrip("/") + "/"
+        for files in self._files.values():
+            for path in [path for path in files if path.startswith(prefix)]:
+                self.used -= files.pop(path)
+
+    async def enforce(self) -> None:
+        victims = []
+        for kind in (DERIVED, ORIGINAL):
+            files = self._files[kind]
+            while self.used > self.budget and files:
+                path, size = files.popitem(last=False)
+                self.used -= size
+                victims.append(path)
+
+        for path in victims:
+            logger.info(f"Evicting {path} to stay within {self.budget} bytes")
+            await asyncio.to_thread(_remove_file, path)
+            self.evictions += 1
+            self._evicted[path] = True
+            while len(self._evicted) > self._remembered_evictions:
+                self._evicted.popitem(last=False)
+
+    def rebuild(self, root: str) -> None:
+        """One-time scan at startup of the files previous runs left."""
+        if not os.path.isdir(root):
+            return
+
+        entries = []
+        for folder in os.scandir(root):
+            if folder.is_dir():
+                for entry in os.scandir(folder.path):
+                    if entry.is_file():
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, entry.path, stat.st_size))
+
+        for _, path, size in sorted(entries):
+            kind = self.kind_of(path)
+            self._files[kind][path] = size
+            self.used += size
+
+        logger.info(f"Disk store rebuilt: {self.usage()}")
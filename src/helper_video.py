@@ -0,0 +1,424 @@
+import io
+import os
+import math
+import asyncio
+import logging
+import numpy
+
+from bisect import bisect_right
+from fractions import Fraction
+from dotenv import load_dotenv
+from PIL import Image, ImageSequence
+
+from helper_aws import detect_faces
+from helper_faces import FaceBox
+from helper_images import (
+    anonymize_faces,
+    default_anonymize_mode,
+    detection_jpeg_quality,
+    detection_max_edge,
+    _in_memory_file,
+    _write_file,
+)
+from helper_metrics import metrics
+from helper_render import run_in_render_pool
+
+try:
+    import av
+except ImportError:
+    av = None
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Detection runs on keyframes only: one every VIDEO_KEYFRAME_INTERVAL seconds
+# (shorter is more accurate on fast motion, longer is faster and cheaper),
+# plus the first frame of every new scene. Boxes in between are interpolated.
+video_keyframe_interval = float(os.getenv("VIDEO_KEYFRAME_INTERVAL", "0.5"))
+video_scene_threshold = float(os.getenv("VIDEO_SCENE_THRESHOLD", "0.25"))  # 0 disables
+video_max_keyframes = int(os.getenv("VIDEO_MAX_KEYFRAMES", "60"))
+# Interpolated boxes are grown by this share of their size on every side
+video_box_margin = float(os.getenv("VIDEO_BOX_MARGIN", "0.15"))
+video_max_edge = int(os.getenv("VIDEO_MAX_EDGE", "1280"))
+video_crf = int(os.getenv("VIDEO_CRF", "23"))
+# Pillow assembles a GIF in memory, one byte per pixel of every frame: a GIF
+# with more frames x pixels than this comes out smaller to stay within it
+video_gif_max_pixels = int(os.getenv("VIDEO_GIF_MAX_PIXELS", str(50 * 1000 * 1000)))
+
+# GIF is decoded and encoded by Pillow; any other clip, including the MP4
+# Telegram turns animations into, needs PyAV (av in requirements.txt)
+gif_extensions = ("gif",)
+
+
+def clip_supported(mime_type: str) -> bool:
+    """Whether a clip of this type can be decoded here."""
+    return mime_type == "image/gif" or av is not None
+
+
+def _is_gif(extension: str) -> bool:
+    return extension.lower() in gif_extensions
+
+
+def _open_source(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    return source
+
+
+def _frames(source, extension: str):
+    """Decode a clip one frame at a time: (index, seconds, duration, RGB image).
+
+    Only the current frame is held in memory, whatever the clip length.
+    """
+    if _is_gif(extension):
+        image = Image.open(_open_source(source))
+        seconds = 0.0
+        for index, frame in enumerate(ImageSequence.Iterator(image)):
+            duration = frame.info.get("duration", 100) / 1000 or 0.1
+            yield index, seconds, duration, frame.convert("RGB")
+            seconds += duration
+        return
+
+    if av is None:
+        raise RuntimeError("Video clips need PyAV: pip install av")
+    container = av.open(_open_source(source))
+    try:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        duration = 1 / float(stream.average_rate or 25)
+        for index, frame in enumerate(container.decode(stream)):
+            seconds = float(frame.time) if frame.time is not None else index * duration
+            yield index, seconds, duration, frame.to_image()
+    finally:
+        container.close()
+
+
+def _signature(image: Image.Image) -> numpy.ndarray:
+    """Tiny grayscale thumbnail, compared between frames to spot scene changes."""
+    return numpy.asarray(
+        image.convert("L").resize((16, 16), Image.BILINEAR), dtype=numpy.int16
+    )
+
+
+def _keyframe_jpeg(image: Image.Image) -> bytes:
+    image = image.copy()
+    image.thumbnail((detection_max_edge, detection_max_edge), Image.BILINEAR)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=detection_jpeg_quality)
+    return buffer.getvalue()
+
+
+@metrics.span("video_keyframes")
+def extract_keyframes(
+    source, extension: str, interval: float, scene_threshold: float, max_keyframes: int
+) -> tuple:
+    """First pass: pick the keyframes and encode them for detection.
+
+    Returns ([(frame index, starts a scene, JPEG bytes)], frame count). The
+    last frame is always a keyframe, so interpolation reaches the end. When
+    there are more than `max_keyframes`, they are thinned (see
+    `_thin_keyframes`) and the interval doubled. Runs in the render pool.
+    """
+    keyframes = []
+    last_key_seconds = None
+    previous = None
+    last_frame = None
+    frame_count = 0
+
+    for index, seconds, _, image in _frames(source, extension):
+        frame_count = index + 1
+        signature = _signature(image)
+        scene_cut = bool(
+            scene_threshold
+            and previous is not None
+            and numpy.abs(signature - previous).mean() / 255 > scene_threshold
+        )
+        previous = signature
+
+        # The epsilon absorbs the rounding of summed GIF frame durations
+        if (
+            last_key_seconds is None
+            or scene_cut
+            or seconds - last_key_seconds >= interval - 1e-6
+        ):
+            keyframes.append((index, scene_cut, _keyframe_jpeg(image)))
+            last_key_seconds = seconds
+            last_frame = None
+            if len(keyframes) > max_keyframes:
+                keyframes = _thin_keyframes(keyframes, max_keyframes)
+                interval *= 2
+        else:
+            last_frame = (index, image)
+
+    if last_frame is not None:
+        keyframes.append((last_frame[0], False, _keyframe_jpeg(last_frame[1])))
+        if len(keyframes) > max_keyframes:
+            keyframes = _thin_keyframes(keyframes, max_keyframes)
+    return keyframes, frame_count
+
+
+def _thin_keyframes(keyframes: list, max_keyframes: int) -> list:
+    """Every second keyframe, always keeping the first and the last one.
+
+    Scene cuts are kept too while they fit: without them the boxes of one
+    scene would be interpolated into the next.
+    """
+    last = len(keyframes) - 1
+    thinned = [
+        keyframe
+        for position, keyframe in enumerate(keyframes)
+        if position % 2 == 0 or position == last or keyframe[1]
+    ]
+    if len(thinned) > max_keyframes:
+        thinned = keyframes[:last:2] + [keyframes[last]]
+    return thinned
+
+
+def _center_distance(a: FaceBox, b: FaceBox) -> float:
+    """Distance between the box centers, in box sizes."""
+    size = max(a.width, a.height, b.width, b.height) or 1.0
+    return (
+        math.hypot(
+            (a.left + a.width / 2) - (b.left + b.width / 2),
+            (a.top + a.height / 2) - (b.top + b.height / 2),
+        )
+        / size
+    )
+
+
+class FaceTimeline:
+    """Face boxes of every frame, from the detections of the keyframes.
+
+    Between two keyframes, each face is matched with the nearest face of
+    the next keyframe (greedily, within one box size) and its box moves
+    linearly from one to the other. A face without a match is held still
+    over the whole segment: a face seen once is covered, even if it is
+    missed or hidden at the other end. No interpolation across a scene
+    change: the boxes of the previous scene are held until the cut.
+    """
+
+    def __init__(self, keyframe_faces: list, margin: float = 0.0):
+        self.keyframes = [
+            (index, scene_cut, [FaceBox.from_record(record) for record in records])
+            for index, scene_cut, records in sorted(
+                keyframe_faces, key=lambda keyframe: keyframe[0]
+            )
+        ]
+        self.indexes = [index for index, _, _ in self.keyframes]
+        self.margin = margin
+        self._tracks = {}
+
+    def _segment_tracks(self, position: int) -> list:
+        """(start box, end box) pairs between keyframe `position` and the next one."""
+        tracks = self._tracks.get(position)
+        if tracks is not None:
+            return tracks
+
+        _, _, start_faces = self.keyframes[position]
+        if position + 1 >= len(self.keyframes) or self.keyframes[position + 1][1]:
+            tracks = [(face, face) for face in start_faces]
+        else:
+            end_faces = self.keyframes[position + 1][2]
+            candidates = sorted(
+                (_center_distance(start, end), i, j)
+                for i, start in enumerate(start_faces)
+                for j, end in enumerate(end_faces)
+            )
+            matched_start, matched_end = {}, set()
+            for distance, i, j in candidates:
+                if distance > 1.0:
+                    break
+                if i not in matched_start and j not in matched_end:
+                    matched_start[i] = j
+                    matched_end.add(j)
+            tracks = [
+                (start, end_faces[matched_start[i]] if i in matched_start else start)
+                for i, start in enumerate(start_faces)
+            ]
+            tracks += [
+                (end, end) for j, end in enumerate(end_faces) if j not in matched_end
+            ]
+
+        self._tracks[position] = tracks
+        return tracks
+
+    def _grow(self, left: float, top: float, width: float, height: float) -> FaceBox:
+        dx, dy = width * self.margin, height * self.margin
+        right, bottom = min(1.0, left + width + dx), min(1.0, top + height + dy)
+        left, top = max(0.0, left - dx), max(0.0, top - dy)
+        return FaceBox(left, top, right - left, bottom - top)
+
+    def boxes(self, index: int) -> list:
+        position = max(0, bisect_right(self.indexes, index) - 1)
+        start_index = self.indexes[position]
+        end_index = (
+            self.indexes[position + 1]
+            if position + 1 < len(self.indexes)
+            else start_index
+        )
+        t = (
+            (index - start_index) / (end_index - start_index)
+            if end_index > start_index
+            else 0.0
+        )
+
+        return [
+            self._grow(
+                start.left + (end.left - start.left) * t,
+                start.top + (end.top - start.top) * t,
+                start.width + (end.width - start.width) * t,
+                start.height + (end.height - start.height) * t,
+            )
+            for start, end in self._segment_tracks(position)
+        ]
+
+
+def _output_size(image: Image.Image, even: bool, max_pixels: int = 0) -> tuple:
+    scale = min(1.0, video_max_edge / max(image.size)) if video_max_edge else 1.0
+    if max_pixels:
+        scale = min(scale, math.sqrt(max_pixels / (image.width * image.height)))
+    width, height = max(2, round(image.width * scale)), max(
+        2, round(image.height * scale)
+    )
+    if even:
+        # yuv420p wants even dimensions
+        width, height = width - width % 2, height - height % 2
+    return width, height
+
+
+def _encode_gif(frames) -> bytes:
+    images, durations = [], []
+    for image, duration in frames:
+        images.append(image.convert("P", palette=Image.ADAPTIVE))
+        durations.append(round(duration * 1000))
+    buffer = io.BytesIO()
+    images[0].save(
+        buffer,
+        format="GIF",
+        save_all=True,
+        append_images=images[1:],
+        duration=durations,
+        loop=0,
+    )
+    return buffer.getvalue()
+
+
+def _encode_mp4(frames) -> bytes:
+    buffer = io.BytesIO()
+    output = av.open(buffer, mode="w", format="mp4")
+    stream = None
+    for image, duration in frames:
+        if stream is None:
+            stream = output.add_stream(
+                "libx264", rate=Fraction(1 / duration).limit_denominator(1001)
+            )
+            stream.width, stream.height = image.size
+            stream.pix_fmt = "yuv420p"
+            stream.options = {
+                "crf": str(video_crf),
+                "preset": "veryfast",
+                "movflags": "+faststart",
+            }
+        for packet in stream.encode(av.VideoFrame.from_image(image)):
+            output.mux(packet)
+    if stream is not None:
+        for packet in stream.encode():
+            output.mux(packet)
+    output.close()
+    return buffer.getvalue()
+
+
+@metrics.span("video_render")
+def render_clip(
+    source,
+    extension: str,
+    keyframe_faces: list,
+    mode: str = "blur",
+    margin: float = 0.0,
+    frame_count: int = 0,
+) -> bytes:
+    """Second pass: anonymize every frame and re-encode the clip.
+
+    GIF in, GIF out; anything else comes out as an H.264 MP4 without sound.
+    Frames are streamed from the decoder to the encoder. A GIF is only
+    assembled at the end, Pillow writes it in one go, so its `frame_count`
+    frames are scaled down to stay within VIDEO_GIF_MAX_PIXELS. Runs in the
+    render pool.
+    """
+    timeline = FaceTimeline(keyframe_faces, margin)
+    gif = _is_gif(extension)
+    max_pixels = video_gif_max_pixels // frame_count if gif and frame_count else 0
+
+    def anonymized_frames():
+        size = None
+        for index, _, duration, image in _frames(source, extension):
+            if size is None:
+                size = _output_size(image, even=not gif, max_pixels=max_pixels)
+            if image.size != size:
+                image = image.resize(size, Image.BILINEAR)
+            yield anonymize_faces(image, timeline.boxes(index), mode), duration
+
+    return _encode_gif(anonymized_frames()) if gif else _encode_mp4(anonymized_frames())
+
+
+async def generate_anonymized_clip(
+    source,
+    output_path: str,
+    original_filename: str,
+    original_extension: str,
+    mode: str = None,
+) -> tuple:
+    """Anonymize every face of a video or GIF clip.
+
+    Keyframes go through `detect_faces`, like photos (cache, concurrency
+    limits and deadlines included). Returns the clip, in memory or on disk
+    like generate_blurred, and the most faces seen on one keyframe; the
+    clip is None when no keyframe has a face.
+    """
+    mode = mode or default_anonymize_mode
+
+    keyframes, frame_count = await run_in_render_pool(
+        extract_keyframes,
+        source,
+        original_extension,
+        video_keyframe_interval,
+        video_scene_threshold,
+        video_max_keyframes,
+    )
+    with metrics.span("video_detection"):
+        detections = await asyncio.gather(
+            *[detect_faces(jpeg) for _, _, jpeg in keyframes]
+        )
+    logger.info(
+        f"Clip of {frame_count} frame(s), {len(keyframes)} keyframe(s) detected"
+    )
+
+    faces_max = max((len(faces) for faces in detections), default=0)
+    if not faces_max:
+        return None, 0
+
+    keyframe_faces = [
+        (index, scene_cut, [face.to_record() for face in faces])
+        for (index, scene_cut, _), faces in zip(keyframes, detections)
+    ]
+    content = await run_in_render_pool(
+        render_clip,
+        source,
+        original_extension,
+        keyframe_faces,
+        mode,
+        video_box_margin,
+        frame_count,
+    )
+
+    extension = "gif" if _is_gif(original_extension) else "mp4"
+    new_file_name = f"{original_filename}-blurried.{extension}"
+    if output_path is None:
+        return _in_memory_file(new_file_name, content), faces_max
+
+    new_file_name = f"{output_path}/{new_file_name}"
+    await asyncio.to_thread(_write_file, new_file_name, content)
+
+    return new_file_name, faces_max
@@ -0,0 +1,85 @@
+"""Every anonymization mode on photos that are not RGB (grayscale, palette).
+
+Both render paths are covered: the direct one (`render_blurred`) and the
+precomputed face patches (`render_face_patches` + `compose_blurred`).
+"""
+
+import io
+import os
+import sys
+import unittest
+
+from PIL import Image, ImageDraw
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from helper_faces import FaceBox  # noqa: E402
+from helper_images import (  # noqa: E402
+    anonymize_modes,
+    border_size,
+    compose_blurred,
+    fill_color,
+    render_blurred,
+    render_face_patches,
+)
+
+BOXES = [
+    FaceBox(left=0.1, top=0.1, width=0.3, height=0.3),
+    FaceBox(left=0.6, top=0.5, width=0.3, height=0.4),
+]
+
+
+def photo(mode: str, image_format: str) -> bytes:
+    """A 200x150 photo in `mode`, with some detail for the blur to smooth."""
+    image = Image.new("RGB", (200, 150), (200, 180, 160))
+    draw = ImageDraw.Draw(image)
+    for x in range(0, 200, 10):
+        draw.line([(x, 0), (x, 150)], fill=(20, 40, 60), width=3)
+    if mode == "P":
+        image = image.convert("P", palette=Image.ADAPTIVE)
+    else:
+        image = image.convert(mode)
+    buffer = io.BytesIO()
+    image.save(buffer, image_format)
+    return buffer.getvalue()
+
+
+class AnonymizeModesTest(unittest.TestCase):
+    cases = (("L", "JPEG"), ("L", "PNG"), ("P", "PNG"), ("P", "GIF"))
+
+    def check(self, content: bytes, source: bytes, anonymize_mode: str) -> None:
+        original = Image.open(io.BytesIO(source)).convert("RGB")
+        result = Image.open(io.BytesIO(content)).convert("RGB")
+        self.assertEqual(
+            result.size,
+            (original.width + 2 * border_size, original.height + 2 * border_size),
+        )
+        if anonymize_mode in ("fill", "box"):
+            # Center of the first face, past the border
+            center = (
+                border_size + int(original.width * 0.25),
+                border_size + int(original.height * 0.25),
+            )
+            self.assertEqual(result.getpixel(center), fill_color)
+
+    def test_render_blurred(self):
+        for image_mode, image_format in self.cases:
+            source = photo(image_mode, image_format)
+            for anonymize_mode in anonymize_modes:
+                with self.subTest(image_mode, format=image_format, mode=anonymize_mode):
+                    content = render_blurred(source, BOXES, "PNG", anonymize_mode)
+                    self.check(content, source, anonymize_mode)
+
+    def test_face_patches(self):
+        for image_mode, image_format in self.cases:
+            source = photo(image_mode, image_format)
+            for anonymize_mode in anonymize_modes:
+                with self.subTest(image_mode, format=image_format, mode=anonymize_mode):
+                    patches = render_face_patches(source, BOXES, anonymize_mode)
+                    content = compose_blurred(patches, [1, 2], "PNG")
+                    self.check(content, source, anonymize_mode)
+
+
+if __name__ == "__main__":
+    unittest.main()
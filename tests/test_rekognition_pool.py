@@ -0,0 +1,194 @@
+"""Failover and throttling backoff of the Rekognition client pool.
+
+Runs against benchmarks/fake_rekognition.py servers on local ports, no AWS
+account needed:
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import glob
+import time
+import socket
+import threading
+import unittest
+
+from http.server import ThreadingHTTPServer
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+# boto3 signs the requests to the fake endpoints: any credentials will do
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+import botocore  # noqa: E402
+
+from botocore.config import Config  # noqa: E402
+from fake_rekognition import FakeRekognitionHandler  # noqa: E402
+from helper_detectors import ReplayDetector  # noqa: E402
+from helper_rekognition import create_rekognition_pool, parse_endpoints  # noqa: E402
+
+SAMPLES = os.path.join(ROOT, "samples")
+
+
+def start_fake():
+    """A fake Rekognition endpoint on a free local port, with its own settings."""
+    handler = type(
+        "Handler",
+        (FakeRekognitionHandler,),
+        {
+            "detector": ReplayDetector(SAMPLES),
+            "throttle": 0.0,
+            "calls": 0,
+            "throttled": 0,
+        },
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, handler
+
+
+def closed_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class RekognitionPoolTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.servers = {name: start_fake() for name in ("healthy", "throttled")}
+        sample = sorted(glob.glob(os.path.join(SAMPLES, "*.jpg.json")))[0]
+        with open(sample[: -len(".json")], "rb") as image_file:
+            cls.image_bytes = image_file.read()
+
+    @classmethod
+    def tearDownClass(cls):
+        for server, _ in cls.servers.values():
+            server.shutdown()
+            server.server_close()
+
+    def setUp(self):
+        for name, (_, handler) in self.servers.items():
+            handler.calls = handler.throttled = 0
+            handler.throttle = 1.0 if name == "throttled" else 0.0
+
+    def url(self, name: str) -> str:
+        server, _ = self.servers[name]
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    def calls(self, name: str) -> int:
+        return self.servers[name][1].calls
+
+    def pool(
+        self, *urls, strategy="least_in_flight", backoff_base=1.0, backoff_max=60.0
+    ):
+        entries = ",".join(
+            f"name={index};region=eu-west-1;endpoint_url={url}"
+            for index, url in enumerate(urls)
+        )
+        config = Config(
+            connect_timeout=1,
+            read_timeout=5,
+            retries={"total_max_attempts": 1, "mode": "standard"},
+        )
+        return create_rekognition_pool(
+            parse_endpoints(entries),
+            config,
+            strategy=strategy,
+            backoff_base=backoff_base,
+            backoff_max=backoff_max,
+        )
+
+    def detect(self, pool) -> dict:
+        return pool.detect_faces(
+            Image={"Bytes": self.image_bytes}, Attributes=["DEFAULT"]
+        )
+
+    def test_throttled_call_fails_over(self):
+        pool = self.pool(self.url("throttled"), self.url("healthy"))
+        throttled, healthy = pool.clients
+
+        response = self.detect(pool)
+
+        self.assertIn("FaceDetails", response)
+        self.assertEqual(self.calls("throttled"), 1)
+        self.assertEqual(self.calls("healthy"), 1)
+        self.assertEqual(throttled.throttles, 1)
+        self.assertGreater(throttled.backoff_until, time.monotonic())
+        self.assertEqual(healthy.throttles, 0)
+        self.assertEqual(throttled.in_flight + healthy.in_flight, 0)
+
+    def test_backed_off_client_is_skipped(self):
+        pool = self.pool(self.url("throttled"), self.url("healthy"))
+
+        for _ in range(5):
+            self.detect(pool)
+
+        # Only the first call found out about the throttling
+        self.assertEqual(self.calls("throttled"), 1)
+        self.assertEqual(self.calls("healthy"), 5)
+
+    def test_unreachable_client_fails_over(self):
+        pool = self.pool(f"http://127.0.0.1:{closed_port()}", self.url("healthy"))
+        unreachable, _ = pool.clients
+
+        self.assertIn("FaceDetails", self.detect(pool))
+        self.assertEqual(unreachable.throttles, 1)
+        self.assertGreater(unreachable.backoff_until, time.monotonic())
+
+    def test_every_client_throttled_raises(self):
+        pool = self.pool(self.url("throttled"), self.url("throttled"))
+
+        with self.assertRaises(botocore.exceptions.ClientError) as raised:
+            self.detect(pool)
+
+        self.assertEqual(
+            raised.exception.response["Error"]["Code"], "ThrottlingException"
+        )
+        self.assertEqual(self.calls("throttled"), 2)
+        self.assertEqual([pooled.in_flight for pooled in pool.clients], [0, 0])
+
+    def test_backoff_doubles_up_to_max(self):
+        pool = self.pool(self.url("throttled"), backoff_base=1.0, backoff_max=4.0)
+        (throttled,) = pool.clients
+
+        for throttles, delay in ((1, 1.0), (2, 2.0), (3, 4.0), (4, 4.0)):
+            start = time.monotonic()
+            with self.assertRaises(botocore.exceptions.ClientError):
+                self.detect(pool)
+            self.assertEqual(throttled.throttles, throttles)
+            # Jittered between half the delay and the delay
+            self.assertGreaterEqual(throttled.backoff_until - start, delay / 2)
+            self.assertLessEqual(throttled.backoff_until - time.monotonic(), delay)
+
+    def test_success_resets_backoff(self):
+        pool = self.pool(self.url("throttled"))
+        (pooled,) = pool.clients
+        with self.assertRaises(botocore.exceptions.ClientError):
+            self.detect(pool)
+
+        # Same endpoint, recovered
+        self.servers["throttled"][1].throttle = 0.0
+        pooled.backoff_until = 0.0
+        self.assertIn("FaceDetails", self.detect(pool))
+        self.assertEqual(pooled.throttles, 0)
+        self.assertIsNotNone(pooled.latency)
+
+    def test_latency_strategy_prefers_faster_client(self):
+        pool = self.pool(self.url("healthy"), self.url("healthy"), strategy="latency")
+        slow, fast = pool.clients
+        slow.latency, fast.latency = 1.0, 0.01
+
+        self.detect(pool)
+
+        self.assertEqual(fast.in_flight + slow.in_flight, 0)
+        self.assertLess(fast.latency, 1.0)
+        self.assertEqual(slow.latency, 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()